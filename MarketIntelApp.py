@@ -4,6 +4,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from datetime import datetime, timedelta, date
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import config
 import importlib
 importlib.reload(config)
@@ -13,6 +14,7 @@ importlib.reload(utils)
 st.set_page_config(page_title="Timber Intel Core", page_icon="🌲", layout="wide")
 
 st.title("🌲 Timber Intel - Analysis Dashboard (情报分析看板)")
+utils.render_schema_notice()
 
 # --- 0. 状态管理 (防止页面刷新后数据丢失) ---
 if 'report_active' not in st.session_state:
@@ -169,48 +171,50 @@ if is_date_valid and start_d and end_d:
         chunk_days = 7          
         
         needed_columns = "transaction_date,hs_code,product_desc_text,origin_country_code,dest_country_code,quantity,quantity_unit,total_value_usd,port_of_arrival,port_of_departure,exporter_name,importer_name,unique_record_id"
+        enriched = utils.enrichment_enabled()
+        if enriched:
+            # 入库时已计算的派生列，树种筛选也在数据库端完成
+            needed_columns += ",species,product_category,port_of_arrival_clean,port_of_departure_clean,origin_name,dest_name"
+        species_filter = ana_species_selected if enriched else None
+        # 按树种筛选时另取一遍尚未回填派生列的旧记录 (species 为空)，由 enrich_frame 本地识别后在渲染时筛选
+        species_passes = [{"species": species_filter}, {"unenriched": True}] if species_filter else [{}]
+        
+        def fetch_chunk(chunk_start, chunk_end):
+            """在工作线程中读取一个日期分片 (keyset 分页，不调用 st.*)。"""
+            chunk_rows = []
+            for species_pass in species_passes:
+                for rows in utils.get_trade_store().iter_pages(
+                    needed_columns, page_size=batch_size,
+                    start_date=chunk_start, end_date=chunk_end,
+                    origin_codes=ana_origins, dest_codes=ana_dests, hs_prefixes=final_ana_hs_codes, **species_pass
+                ):
+                    chunk_rows.extend(rows)
+            return chunk_rows
         
         with st.status("🚀 Starting Data Extraction (正在启动分片提取)...", expanded=True) as status:
             msg_placeholder = st.empty()
             progress_bar = st.progress(0)
             
             try:
-                current_start_dt = datetime.combine(start_d, datetime.min.time())
-                end_dt = datetime.combine(end_d, datetime.min.time())
-
-                total_days = (end_dt - current_start_dt).days
-                if total_days <= 0: total_days = 1
+                # 按 chunk_days 切分日期分片，由线程池并发读取，完成后按日期顺序合并
+                chunks = []
+                current_chunk_start = start_d
+                while current_chunk_start <= end_d:
+                    current_chunk_end = min(current_chunk_start + timedelta(days=chunk_days), end_d)
+                    chunks.append((current_chunk_start, current_chunk_end))
+                    current_chunk_start = current_chunk_end + timedelta(days=1)
                 
-                current_chunk_start = current_start_dt
+                chunk_results = [None] * len(chunks)
+                with ThreadPoolExecutor(max_workers=config.HOME_LOAD_WORKERS) as pool:
+                    futures = {pool.submit(fetch_chunk, cs, ce): i for i, (cs, ce) in enumerate(chunks)}
+                    for done_count, fut in enumerate(as_completed(futures), 1):
+                        chunk_results[futures[fut]] = fut.result()
+                        cs, ce = chunks[futures[fut]]
+                        progress_bar.progress(min(done_count / len(chunks), 0.99))
+                        msg_placeholder.info(f"📅 Fetched {done_count}/{len(chunks)} chunks (latest: {cs} to {ce}) ... (Records: {sum(len(r) for r in chunk_results if r)})")
                 
-                while current_chunk_start <= end_dt:
-                    current_chunk_end = min(current_chunk_start + timedelta(days=chunk_days), end_dt)
-                    
-                    days_done = (current_chunk_start - current_start_dt).days
-                    progress = min(days_done / total_days, 0.99)
-                    progress_bar.progress(progress)
-                    msg_placeholder.info(f"📅 Fetching: {current_chunk_start.date()} to {current_chunk_end.date()} ... (Records: {len(all_rows)})")
-                    
-                    chunk_offset = 0
-                    while True:
-                        query = utils.supabase.table('trade_records')\
-                            .select(needed_columns)\
-                            .gte('transaction_date', current_chunk_start.date())\
-                            .lte('transaction_date', current_chunk_end.date())
-                        
-                        if ana_origins: query = query.in_('origin_country_code', ana_origins)
-                        if ana_dests: query = query.in_('dest_country_code', ana_dests)
-                        
-                        response = query.range(chunk_offset, chunk_offset + batch_size - 1).execute()
-                        rows = response.data
-                        
-                        if not rows: break
-                        
-                        all_rows.extend(rows)
-                        chunk_offset += len(rows)
-                        if len(rows) < batch_size: break
-                    
-                    current_chunk_start = current_chunk_end + timedelta(days=1)
+                for rows in chunk_results:
+                    all_rows.extend(rows)
                 
                 progress_bar.progress(1.0)
                 msg_placeholder.empty()
@@ -219,7 +223,10 @@ if is_date_valid and start_d and end_d:
                 if all_rows:
                     df = pd.DataFrame(all_rows)
                     df = df.sort_values(by='transaction_date', ascending=False)
+                    df = utils.enrich_frame(df)
                     st.session_state['analysis_df'] = df
+                    st.session_state['analysis_hs_codes'] = list(final_ana_hs_codes)
+                    st.session_state['analysis_species'] = list(species_filter or [])
                     st.session_state['report_active'] = True
                 else:
                     st.session_state['report_active'] = False
@@ -239,32 +246,21 @@ if st.session_state.get('report_active', False) and not st.session_state['analys
     df['total_value_usd'] = pd.to_numeric(df['total_value_usd'], errors='coerce').fillna(0)
 
     # --- 数据清洗 ---
-    df['port_of_arrival'] = df['port_of_arrival'].fillna('Unknown').astype(str).apply(
-        lambda x: x.split('(')[-1].replace(')', '').strip() if '(' in x else x.strip()
-    )
-    if 'port_of_departure' in df.columns:
-        df['port_of_departure'] = df['port_of_departure'].fillna('Unknown').astype(str).apply(
-            lambda x: x.split('(')[-1].replace(')', '').strip() if '(' in x else x.strip()
-        )
-    else:
-        df['port_of_departure'] = 'Unknown'
-
-    name_fix_map = {
-        "VIZAG": "Visakhapatnam", "VIZAG SEA": "Visakhapatnam",
-        "GOA": "Mormugao (Goa)", "GOA PORT": "Mormugao (Goa)"
-    }
-    df['port_of_arrival'] = df['port_of_arrival'].replace(name_fix_map)
-    if hasattr(config, 'PORT_CODE_TO_NAME'):
-        df['port_of_arrival'] = df['port_of_arrival'].replace(config.PORT_CODE_TO_NAME)
+    # 港口、树种、国家名已在加载时由 utils.enrich_frame 整理 (优先使用入库时计算的派生列)
+    if not df.attrs.get('enriched'):
+        df = utils.enrich_frame(df)
+        st.session_state['analysis_df'] = df
     
     # --- 基础筛选 ---
+    # 加载时已按 HS 前缀在数据库端过滤；此处只处理加载后缩小的 HS 选择
+    missing_hs = set(final_ana_hs_codes) - set(st.session_state.get('analysis_hs_codes', final_ana_hs_codes))
+    if missing_hs:
+        st.info(f"ℹ️ HS {', '.join(sorted(missing_hs))} not in the loaded report. Click Load Analysis Report again (新增的 HS 需重新加载报告).")
+    loaded_species = st.session_state.get('analysis_species') or []
+    if loaded_species and (not ana_species_selected or set(ana_species_selected) - set(loaded_species)):
+        st.info("ℹ️ The report was loaded for fewer species. Click Load Analysis Report again (树种选择已扩大，需重新加载报告).")
     df['match_hs'] = df['hs_code'].astype(str).apply(lambda x: any(x.startswith(t) for t in final_ana_hs_codes))
     df = df[df['match_hs']]
-    
-    if 'product_desc_text' in df.columns:
-        df['Species'] = df['product_desc_text'].apply(utils.identify_species)
-    else:
-        df['Species'] = 'Unknown'
 
     # --- 更新后的软硬木互斥逻辑 (适配多选) ---
     has_softwood = any("Softwood" in cat for cat in selected_categories)
@@ -288,15 +284,6 @@ if st.session_state.get('report_active', False) and not st.session_state['analys
     else:
         df['unit_price'] = df.apply(lambda x: x['total_value_usd'] / x['quantity'] if x['quantity'] > 0 else 0, axis=1)
         
-        def get_country_name_en(code):
-            if pd.isna(code) or code == "" or code is None: return "Unknown"
-            full_name = config.COUNTRY_NAME_MAP.get(code, code)
-            full_name_str = str(full_name)
-            if '(' in full_name_str: return full_name_str.split(' (')[0]
-            return full_name_str
-
-        df['origin_name'] = df['origin_country_code'].apply(get_country_name_en)
-        df['dest_name'] = df['dest_country_code'].apply(get_country_name_en)
         df['Month'] = pd.to_datetime(df['transaction_date']).dt.to_period('M').astype(str)
         sorted_months = sorted(df['Month'].unique())
 
@@ -229,4 +229,135 @@ PORT_CODE_TO_NAME = {
     "INMBD6": "ICD MORADABAD", "INPNK6": "ICD PANKI", "INPTL6": "ICD PATLI",
     "INBDM6": "ICD BADDI", "INTMX6": "ICD TIMMAPUR", "INSAJ6": "ICD SACHIN",
     "INAKP6": "ICD ANKLESHWAR", "INAJM6": "ICD AJMER", "INNDA6": "ICD NOIDA"
-}
\ No newline at end of file
+}
+
+# ==========================================
+# 8. 批量下载引擎参数 (Batch Download Engine)
+# ==========================================
+DOWNLOAD_MAX_IN_FLIGHT = 6        # 同时在途的 Tendata 请求上限 (线程池大小)
+DOWNLOAD_MAX_IN_FLIGHT_LIMIT = 16  # 页面上可选的单任务在途请求上限 (连接池按此容量分配)
+DOWNLOAD_PAGE_SIZE = 100          # 每页条数 (pageSize)，用于由 total 计算精确页数
+
+# ==========================================
+# 9. Tendata HTTP 客户端参数 (连接池 / 超时 / 压缩)
+# ==========================================
+TENDATA_HTTP_POOL_SIZE = 16       # 连接池最小大小；实际按 下载任务数 × 在途上限 + 计数并发 取较大值 (见 utils.tendata_pool_size)
+TENDATA_CONNECT_TIMEOUT = 5       # 建立连接超时 (秒)
+TENDATA_READ_TIMEOUT = 60         # 读取响应超时 (秒)
+TENDATA_GZIP_RESPONSE = True      # 请求服务端 gzip 压缩响应
+TENDATA_GZIP_REQUEST = False      # 以 gzip 压缩 POST 请求体 (需服务端支持 Content-Encoding: gzip)
+
+# ==========================================
+# 10. 下载任务日志 (断点续传)
+# ==========================================
+JOB_JOURNAL_PATH = "download_journal.sqlite"   # 本地 SQLite 文件，记录已完成的 (HS, 方向, 日期, 筛选, 页码)
+
+# ==========================================
+# 11. 后台下载 Worker
+# ==========================================
+INGEST_MAX_CONCURRENT_JOBS = 2    # 同时运行的下载任务数，其余排队
+INGEST_JOB_HISTORY = 50           # 保留的已结束任务数量
+INGEST_JOB_LOG_LINES = 300        # 每个任务保留的日志行数
+INGEST_POLL_SECONDS = 2           # 页面轮询任务状态的间隔 (秒)
+
+# ==========================================
+# 12. 入库写缓冲 (trade_records 批量 upsert)
+# ==========================================
+STORE_RAW_DATA = True             # 是否随每行上传完整的 raw_data JSON (关闭可显著减少写入字节)
+WRITE_BUFFER_MAX_ROWS = 2000      # 缓冲行数达到该值即触发 flush
+WRITE_BUFFER_MAX_BYTES = 8_000_000  # 缓冲 (估算 JSON) 字节数达到该值即触发 flush
+WRITE_BUFFER_MAX_SECONDS = 5      # 缓冲中最早的一行等待超过该秒数即触发 flush
+WRITE_BUFFER_MAX_PENDING = 2      # 排队等待写库的批次上限，超过后 add() 阻塞 (背压)
+WRITE_BUFFER_RETRIES = 3          # flush 失败后的重试次数 (指数退避)
+WRITE_BUFFER_BACKOFF_SECONDS = 1.0  # 首次重试等待秒数，之后每次翻倍
+WRITE_BUFFER_RETURNING_MINIMAL = True  # upsert 时使用 Prefer: return=minimal，不回传写入的行
+
+# ==========================================
+# 13. 流式入库流水线 (Fetch -> Normalize -> Write)
+# ==========================================
+PIPELINE_NORMALIZE_QUEUE = 32     # Fetch 与 Normalize 之间的队列容量 (页)，满时暂停派发 API 请求
+PIPELINE_NORMALIZE_WORKERS = 1    # Normalize 线程数
+PIPELINE_METRICS_INTERVAL = 1.0   # 吞吐 / 队列深度指标的刷新间隔 (秒)
+
+# ==========================================
+# 14. 自适应日期窗口拆分 (避免深分页)
+# ==========================================
+DOWNLOAD_WINDOW_MAX_TOTAL = 3000  # 单个 (HS, 方向, 日期窗口) 的 total 超过该值时，日期范围对半拆分
+
+# ==========================================
+# 15. 增量同步 (Sync to Today)
+# ==========================================
+SYNC_OVERLAP_DAYS = 3             # 从高水位往回多拉的天数，用于补录数据源延迟到达的记录 (0 = 只拉高水位之后)
+SYNC_PUBLICATION_LAG_DAYS = 3     # 数据源发布延迟：最近这些天的数据视为可能不完整，高水位最多推进到 今天 - 该天数
+
+# ==========================================
+# 16. 覆盖率规划 (只下载本地缺失的窗口)
+# ==========================================
+PLAN_WINDOW_DAYS = 7              # 规划时每个 (HS, 方向) 的日期窗口天数
+PLAN_MAX_WORKERS = 8              # 规划时并发的计数请求数 (API + 数据库)
+CREDITS_PER_RECORD = 1            # Tendata 每条记录消耗的点数，用于估算节省的点数
+
+# ==========================================
+# 17. Tendata Token 管理
+# ==========================================
+TOKEN_REFRESH_MARGIN_SECONDS = 300  # Token 剩余有效期小于该值时提前刷新 (进程内所有会话共用一个 Token)
+
+# ==========================================
+# 18. Tendata 请求重试与熔断
+# ==========================================
+TENDATA_RETRY_MAX_ATTEMPTS = 4         # 超时 / 网络错误 / 429 / 5xx 的最大重试次数
+TENDATA_RETRY_BASE_SECONDS = 0.5       # 指数退避基数 (秒)，实际等待在 [0, base * 2^n] 内随机抖动
+TENDATA_RETRY_MAX_SECONDS = 30         # 单次退避等待上限 (秒)
+TENDATA_RETRY_BUDGET_RATIO = 0.2       # 重试预算：每个请求存入的额度 (约 20% 的请求可以重试)
+TENDATA_RETRY_BUDGET_MAX = 10          # 重试预算上限 / 初始额度
+TENDATA_BREAKER_FAILURES = 5           # 连续失败次数达到该值时熔断，暂停所有下载线程
+TENDATA_BREAKER_COOLDOWN_SECONDS = 30  # 熔断冷却时间 (秒)，之后放行一个探测请求
+
+# ==========================================
+# 19. Tendata 全局限流 (令牌桶)
+# ==========================================
+TENDATA_RATE_PER_SECOND = 5       # 整个进程 (所有用户、页面、下载线程) 对 Tendata 的持续请求速率
+TENDATA_RATE_BURST = 10           # 允许的突发请求数 (桶容量)
+
+# ==========================================
+# 20. API 数量预检
+# ==========================================
+API_COUNT_MAX_WORKERS = 8         # "Check Volume" 并发的计数请求数
+API_COUNT_CACHE_TTL = 300         # 计数结果缓存秒数 (按完整查询条件)，重复检查同一选择时直接返回
+
+# ==========================================
+# 21. 点数预算 (Credit Budget)
+# ==========================================
+CREDIT_BUDGET_PER_JOB = 50000     # 单个下载任务允许消耗的点数上限 (0 = 不限，仍受账户余额约束)
+
+# ==========================================
+# 22. Tendata 接口地址 (离线压测)
+# ==========================================
+TENDATA_BASE_URL = "https://open-api.tendata.cn"  # 改为 "http://127.0.0.1:8765" 即可对接本地 mock_tendata.py
+
+# ==========================================
+# 23. trade_records 存储后端
+# ==========================================
+STORAGE_BACKEND = "supabase"              # "supabase" = 托管数据库；"sqlite" = 本地嵌入式文件 (离线 / 压测 / 内网)
+LOCAL_STORE_PATH = "trade_records.sqlite" # STORAGE_BACKEND = "sqlite" 时的数据库文件
+
+# ==========================================
+# 24. 首页分析报告加载
+# ==========================================
+HOME_LOAD_WORKERS = 6             # "Load Analysis Report" 并发读取的日期分片数
+
+# ==========================================
+# 25. 入库时计算的派生列 (树种 / 产品分类 / 港口 / 国家名)
+# ==========================================
+ENRICH_ON_INGEST = True           # 写库时同时写入 species 等派生列 (Supabase 需先执行 sql/004_enrichment_columns.sql，未执行时自动关闭并在页面提示)
+ENRICH_BACKFILL_BATCH = 1000      # 回填旧记录时每批读取 / 写回的行数
+PORT_NAME_FIX_MAP = {             # 港口名称修正 (清洗括号后再映射)
+    "VIZAG": "Visakhapatnam", "VIZAG SEA": "Visakhapatnam",
+    "GOA": "Mormugao (Goa)", "GOA PORT": "Mormugao (Goa)"
+}
+
+# ==========================================
+# 26. 覆盖日历 (写入时维护的按天记录数)
+# ==========================================
+USE_COVERAGE_CALENDAR = True      # 库存热力图 / 下载计划读取 trade_coverage_calendar (Supabase 需先执行 sql/007_coverage_calendar.sql，未执行时自动回退)
+SCHEMA_PROBE_RETRY_SECONDS = 60   # 迁移探测因连接问题失败后，间隔多久再探测 (期间按已迁移处理)
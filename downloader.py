@@ -0,0 +1,507 @@
+# downloader.py
+# 批量下载引擎：把 (HS, 方向, 页码) 拆成独立工作单元，以流式流水线并发执行。
+# 流程：先用 pageSize=1 的预检请求拿到每个 (HS, 方向) 的 total；total 超过阈值时把日期范围
+# 递归二分成更小的窗口 (避免深分页)，再按每个窗口的精确页数把所有页码作为独立任务派发。
+# 流水线分三段，段与段之间用有界队列连接 (背压)：
+#   1. Fetch     —— 线程池请求 API (在途数量受 max_in_flight 限制)
+#   2. Normalize —— 把 API 原始 JSON 映射为 trade_records 行 (utils.build_db_rows)
+#   3. Write     —— write_buffer.WriteBuffer 合并成大批次写库
+# 传入 JobJournal 时，已完成的页会被跳过 (断点续传)；一页只有在全部行写库成功后才登记完成。
+# 同一条记录可能被多个关键词 / 窗口同时命中：每个任务按 unique_record_id 只写入、只计数一次。
+
+import collections
+import math
+import queue
+import threading
+import time
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import config
+import utils
+import write_buffer
+
+_STOP = object()  # Normalize 队列结束标记
+
+
+def build_slices(hs_codes, directions):
+    """
+    生成 (HS, 方向) 组合列表，顺序与页面上的旧循环保持一致。
+    DownloadEngine.run() 也接受 (HS, 方向, start_date, end_date)，用于每个组合各自的日期范围
+    (增量同步 / 覆盖率规划)；同一 (HS, 方向) 可以出现多次，表示多个互不重叠的日期窗口。
+    """
+    return [(hs, d) for hs in hs_codes for d in directions]
+
+
+def plan_incremental_slices(watermarks, hs_codes, directions, fallback_start, end_date,
+                            origin_codes=None, dest_codes=None, keyword=None, overlap_days=None):
+    """
+    增量同步：每个 (HS, 方向) 只下载高水位之后的日期。
+    从未同步过的组合从 fallback_start 开始。
+    返回 (slices, up_to_date)：slices 为 (HS, 方向, start, end)，up_to_date 为 [(HS, 方向, last_date)]。
+    """
+    overlap = timedelta(days=config.SYNC_OVERLAP_DAYS if overlap_days is None else overlap_days)
+    end_date = to_date(end_date)
+    slices, up_to_date = [], []
+    for hs, d in build_slices(hs_codes, directions):
+        mark = watermarks.get_watermark(hs, d, origin_codes, dest_codes, keyword)
+        start = mark[1] + timedelta(days=1) - overlap if mark else to_date(fallback_start)
+        if mark and mark[1] >= end_date:
+            up_to_date.append((hs, d, mark[1]))
+        else:
+            slices.append((hs, d, start, end_date))
+    return slices, up_to_date
+
+
+def page_count(total, page_size=None):
+    """根据记录总数计算需要请求的页数。"""
+    page_size = page_size or config.DOWNLOAD_PAGE_SIZE
+    return int(math.ceil(total / float(page_size))) if total > 0 else 0
+
+
+def to_date(value):
+    """页面传入 date，后台任务 / 日志里可能是 'YYYY-MM-DD' 字符串，统一转为 date。"""
+    if isinstance(value, date): return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def split_window(start_date, end_date):
+    """把日期窗口对半拆分；只有一天时无法再拆，返回 None。"""
+    start_date, end_date = to_date(start_date), to_date(end_date)
+    days = (end_date - start_date).days + 1
+    if days <= 1: return None
+    mid = start_date + timedelta(days=days // 2 - 1)
+    return (start_date, mid), (mid + timedelta(days=1), end_date)
+
+
+class StageCounter:
+    """单个流水线阶段的吞吐计数 (线程安全)。"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.items = 0
+        self.rows = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.time()
+
+    def record(self, items=1, rows=0, busy_seconds=0.0):
+        with self._lock:
+            self.items += items
+            self.rows += rows
+            self.busy_seconds += busy_seconds
+
+    def snapshot(self, queue_depth, items=None, rows=None, busy_seconds=None):
+        with self._lock:
+            items = self.items if items is None else items
+            rows = self.rows if rows is None else rows
+            busy = self.busy_seconds if busy_seconds is None else busy_seconds
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        return {
+            "Stage": self.name, "Items": items, "Rows": rows,
+            "Items/s": round(items / elapsed, 2), "Rows/s": round(rows / elapsed, 1),
+            "Busy (s)": round(busy, 1), "Queue Depth": queue_depth,
+        }
+
+
+class DownloadEngine:
+    """
+    有界并发下载器。
+    - max_in_flight: 同时在途的请求上限 (线程池大小)
+    - 预检阶段并发获取每个 (HS, 方向) 的 total，下载阶段按精确页数派发，不再多请求一页来探测末页
+    - window_max_total: 单个日期窗口允许的最大 total，超过则二分日期范围，每个窗口独立浅分页
+    - journal: 可选的 job_journal.JobJournal，每页入库成功后立即登记，重跑时跳过已完成页
+    - cancel_event: 可选的 threading.Event，置位后不再派发新请求，等待在途请求结束后返回
+    - watermarks: 可选的 JobJournal，(HS, 方向) 无错误完成后推进其增量同步高水位
+    - keywords: 可选的关键词列表 (多树种扇出)：每个日期窗口按关键词各发一路请求，并发执行，
+      结果在写缓冲中按 unique_record_id 去重合并 (即各关键词结果的并集)；此时 keyword 只作为高水位的筛选标识
+    - credit_budget: 可选的点数上限；计数完成后预计消耗 (待下载记录数 × CREDITS_PER_RECORD) 超过该值时不开始下载
+    """
+
+    def __init__(self, token, start_date, end_date, origin_codes=None, dest_codes=None, keyword=None, max_in_flight=None, journal=None, cancel_event=None, window_max_total=None, watermarks=None, keywords=None, credit_budget=None):
+        self.token = token
+        self.start_date = start_date
+        self.end_date = end_date
+        self.origin_codes = origin_codes
+        self.dest_codes = dest_codes
+        self.keyword = keyword
+        self.keywords = list(keywords) if keywords else [keyword]
+        self.max_in_flight = min(max(1, int(max_in_flight or config.DOWNLOAD_MAX_IN_FLIGHT)), config.DOWNLOAD_MAX_IN_FLIGHT_LIMIT)
+        self.journal = journal
+        self.cancel_event = cancel_event
+        self.window_max_total = window_max_total or config.DOWNLOAD_WINDOW_MAX_TOTAL
+        self.watermarks = watermarks
+        self.credit_budget = credit_budget
+
+        self.metrics = {
+            "fetch": StageCounter("1. Fetch (API)"),
+            "normalize": StageCounter("2. Normalize"),
+            "write": StageCounter("3. Write (DB)"),
+        }
+        self._fetch_backlog = 0
+        self._in_flight = 0
+        self._normalize_q = None
+        self._writer = None
+        self._seen_lock = threading.Lock()
+        self._seen_ids = set()          # 本次任务已交给写缓冲的 unique_record_id
+        self._duplicates = 0
+
+    # --- 工作线程内执行 ---
+    def _api_token(self):
+        """长任务期间 Token 会轮换：每次请求从进程级 TokenManager 取当前 Token，取不到时退回提交时的 Token。"""
+        return utils.get_token_manager().get_token() or self.token
+
+    def _fetch_total(self, hs, direction, start_date, end_date, keyword):
+        res = utils.fetch_tendata_api(
+            hs, start_date, end_date, self._api_token(), direction,
+            self.origin_codes, self.dest_codes, just_checking=True, keyword=keyword
+        )
+        if res and str(res.get('code')) == '200':
+            return {"ok": True, "total": utils.get_api_total(res)}
+        err_msg = res.get('msg', 'Unknown') if res else 'No Resp'
+        return {"ok": False, "total": 0, "msg": err_msg}
+
+    def _fetch_page(self, hs, direction, start_date, end_date, keyword, page):
+        started = time.time()
+        res = utils.fetch_tendata_api(
+            hs, start_date, end_date, self._api_token(), direction,
+            self.origin_codes, self.dest_codes, just_checking=False, page_no=page, keyword=keyword
+        )
+        if res and str(res.get('code')) == '200':
+            data_node = res.get('data') or {}
+            records = data_node.get('content') or [] if isinstance(data_node, dict) else []
+            self.metrics['fetch'].record(rows=len(records), busy_seconds=time.time() - started)
+            return {"ok": True, "res": res}
+        self.metrics['fetch'].record(busy_seconds=time.time() - started)
+        err_msg = res.get('msg', 'Unknown') if res else 'No Resp'
+        return {"ok": False, "res": None, "msg": err_msg}
+
+    def _normalize_loop(self, on_failed):
+        """Normalize 阶段：从队列取原始页 -> 映射为表行 -> 交给写缓冲 (写缓冲满时阻塞，背压传回上游)。"""
+        while True:
+            item = self._normalize_q.get()
+            if item is _STOP: return
+            ticket, res, window = item
+            page = ticket[-1]
+            started = time.time()
+            try:
+                rows = utils.build_db_rows(res, trade_direction=window['direction'])
+            except Exception as e:
+                on_failed(window, page, f"Normalize failed: {e}")
+                continue
+            window['api_counts'][page] = len(rows)
+            self.metrics['normalize'].record(rows=len(rows), busy_seconds=time.time() - started)
+            self._writer.add(self._unseen_rows(rows), ticket=ticket)
+
+    def _unseen_rows(self, rows):
+        """去掉本次任务中已经交给写缓冲的记录 (其他关键词 / 窗口已命中)，避免重复写库和重复计数。"""
+        fresh = []
+        with self._seen_lock:
+            for row in rows:
+                rid = row.get('unique_record_id')
+                if rid is not None:
+                    if rid in self._seen_ids:
+                        self._duplicates += 1
+                        continue
+                    self._seen_ids.add(rid)
+                fresh.append(row)
+        return fresh
+
+    def _forget_ids(self, ids):
+        """写库失败的记录移出已见集合，之后命中它的页仍会重新写入。"""
+        with self._seen_lock:
+            self._seen_ids.difference_update(ids)
+
+    # --- 主线程调度 ---
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def metrics_snapshot(self):
+        """各阶段吞吐与队列深度，供页面展示。"""
+        normalize_depth = self._normalize_q.qsize() if self._normalize_q is not None else 0
+        breaker = utils.get_circuit_breaker()
+        rows = [
+            self.metrics['fetch'].snapshot(
+                f"{self._fetch_backlog} waiting / {self._in_flight} in flight"
+                + (f" / circuit {breaker.state}" if breaker.state != breaker.CLOSED else "")
+            ),
+            self.metrics['normalize'].snapshot(f"{normalize_depth} pages queued"),
+        ]
+        if self._writer is not None:
+            batches, buffered = self._writer.depth()
+            w = self._writer.stats
+            rows.append(self.metrics['write'].snapshot(
+                f"{batches} batches / {buffered} rows buffered",
+                items=w['flushes'], rows=w['written'], busy_seconds=w['busy_seconds']
+            ))
+        else:
+            rows.append(self.metrics['write'].snapshot("-"))
+        return rows
+
+    def _run_bounded(self, pool, work_items, submit, on_result, on_tick=None):
+        """
+        按顺序派发 work_items (deque)，在途数量不超过 max_in_flight；on_result / on_tick 在主线程回调。
+        on_result 可以向 work_items 追加新任务 (例如拆分后的日期窗口)。
+        """
+        pending = {}
+        while True:
+            if on_tick: on_tick()
+            while work_items and len(pending) < self.max_in_flight and not self.cancelled():
+                item = work_items.popleft()
+                pending[submit(item)] = item
+            self._fetch_backlog = len(work_items)
+            self._in_flight = len(pending)
+            if not pending: break
+            done, _ = wait(list(pending), timeout=config.PIPELINE_METRICS_INTERVAL, return_when=FIRST_COMPLETED)
+            for fut in done:
+                item = pending.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    result = {"ok": False, "total": 0, "msg": str(e)}
+                on_result(item, result)
+        self._fetch_backlog = 0
+        self._in_flight = 0
+
+    def _eta_seconds(self, group):
+        if not group['pages_fetched'] or not group['started_at']: return None
+        elapsed = time.time() - group['started_at']
+        remaining = group['pages_total'] - group['pages_done']
+        return elapsed / group['pages_fetched'] * remaining
+
+    @staticmethod
+    def _todo_records(window):
+        """窗口中尚未下载的页对应的记录数 (末页按余数计)。"""
+        page_size = config.DOWNLOAD_PAGE_SIZE
+        return sum(min(page_size, window['total'] - (p - 1) * page_size) for p in window['todo_pages'])
+
+    def _finish_slice(self, group, emit):
+        if group['reported']: return
+        group['reported'] = True
+        watermark = None
+        # 高水位只推进到已过发布延迟的日期：最近几天的数据可能还会补录，下次同步重新拉取
+        complete_through = min(group['end_date'], date.today() - timedelta(days=config.SYNC_PUBLICATION_LAG_DAYS))
+        if self.watermarks and group['errors'] == 0 and complete_through >= group['start_date']:
+            watermark = self.watermarks.advance_watermark(
+                group['hs'], group['direction'], group['start_date'], complete_through,
+                self.origin_codes, self.dest_codes, self.keyword
+            )
+        emit({"type": "slice_done", "hs": group['hs'], "direction": group['direction'],
+              "saved": group['saved'], "errors": group['errors'], "watermark": watermark})
+
+    def run(self, slices, on_event=None):
+        """
+        执行下载。on_event(event: dict) 在调用 run() 的线程中回调。
+        事件类型: split / planned / page / error / slice_done / metrics / over_budget
+        (HS, 方向) 级别的事件 (planned / slice_done / page 中的进度) 汇总该组合下所有日期窗口和关键词。
+        slices 中的元素可以是 (HS, 方向)、(HS, 方向, start, end) 或 (HS, 方向, start, end, keyword)；
+        前两种按 self.keywords 扇出，最后一种 (覆盖率规划得到的窗口) 只用给定的关键词。
+        返回汇总 stats: {"saved", "pages", "errors", "total", "skipped", "windows", "cancelled", "failed_ids", "db_retries",
+                         "projected_credits", "over_budget", "duplicates"}
+        saved 按 unique_record_id 去重计数；duplicates 为被多个关键词 / 窗口重复命中而跳过的行数。
+        """
+        emit = on_event or (lambda event: None)
+        stats = {"saved": 0, "pages": 0, "errors": 0, "total": 0, "skipped": 0, "windows": 0, "cancelled": False,
+                 "failed_ids": [], "db_retries": 0, "projected_credits": 0, "over_budget": False, "duplicates": 0}
+        groups_by_slice = collections.OrderedDict()
+        for item in slices:
+            hs, d = item[0], item[1]
+            start_date, end_date = (item[2], item[3]) if len(item) >= 4 else (self.start_date, self.end_date)
+            start_date, end_date = to_date(start_date), to_date(end_date)
+            keywords = [item[4]] if len(item) == 5 else self.keywords
+            group = groups_by_slice.get((hs, d))
+            if group is None:
+                group = groups_by_slice[(hs, d)] = {
+                    "hs": hs, "direction": d, "start_date": start_date, "end_date": end_date, "ranges": [],
+                    "counting": 0, "windows": [], "total": 0, "pages_total": 0,
+                    "pages_done": 0, "pages_fetched": 0, "pages_skipped": 0, "journal_reset": False,
+                    "saved": 0, "errors": 0, "started_at": None, "reported": False,
+                }
+            group['ranges'].extend((start_date, end_date, kw) for kw in keywords)
+            group['start_date'] = min(group['start_date'], start_date)
+            group['end_date'] = max(group['end_date'], end_date)
+        groups = list(groups_by_slice.values())
+        if not groups: return stats
+
+        def new_window(group, start_date, end_date, keyword):
+            return {"group": group, "hs": group['hs'], "direction": group['direction'],
+                    "start_date": start_date, "end_date": end_date, "keyword": keyword, "key": None, "total": 0,
+                    "pages_total": 0, "pages_done": 0, "todo_pages": [], "api_counts": {}}
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            # 阶段 1：并发获取 total；超过阈值的窗口二分后重新计数，直到每个窗口都足够浅
+            count_queue = collections.deque()
+            for group in groups:
+                group['counting'] = len(group['ranges'])
+                for start_date, end_date, keyword in group['ranges']:
+                    count_queue.append(new_window(group, start_date, end_date, keyword))
+
+            def plan_window(window, total):
+                group = window['group']
+                window['total'] = total
+                window['pages_total'] = page_count(total)
+                done_pages, was_reset = set(), False
+                if self.journal:
+                    window['key'], filters = self.journal.slice_key(
+                        window['hs'], window['direction'], window['start_date'], window['end_date'],
+                        self.origin_codes, self.dest_codes, window['keyword']
+                    )
+                    done_pages, was_reset = self.journal.plan_slice(
+                        window['key'], window['hs'], window['direction'], window['start_date'], window['end_date'],
+                        filters, total, window['pages_total']
+                    )
+                window['todo_pages'] = [p for p in range(1, window['pages_total'] + 1) if p not in done_pages]
+                window['pages_done'] = window['pages_total'] - len(window['todo_pages'])
+                group['windows'].append(window)
+                group['total'] += total
+                group['pages_total'] += window['pages_total']
+                group['pages_done'] += window['pages_done']
+                group['pages_skipped'] += window['pages_done']
+                group['journal_reset'] = group['journal_reset'] or was_reset
+                stats['total'] += total
+                stats['skipped'] += window['pages_done']
+                stats['windows'] += 1
+
+            def on_total(window, result):
+                group = window['group']
+                group['counting'] -= 1
+                halves = split_window(window['start_date'], window['end_date'])
+                if not result['ok']:
+                    group['errors'] += 1
+                    stats['errors'] += 1
+                    emit({"type": "error", "hs": group['hs'], "direction": group['direction'], "page": None,
+                          "start_date": window['start_date'], "end_date": window['end_date'], "keyword": window['keyword'],
+                          "msg": result['msg']})
+                elif result['total'] > self.window_max_total and halves:
+                    emit({"type": "split", "hs": group['hs'], "direction": group['direction'],
+                          "start_date": window['start_date'], "end_date": window['end_date'], "keyword": window['keyword'],
+                          "total": result['total']})
+                    for start_date, end_date in halves:
+                        group['counting'] += 1
+                        count_queue.append(new_window(group, start_date, end_date, window['keyword']))
+                else:
+                    plan_window(window, result['total'])
+                if group['counting'] == 0:
+                    group['windows'].sort(key=lambda w: (w['start_date'], w['keyword'] or ""))
+                    emit({"type": "planned", "hs": group['hs'], "direction": group['direction'],
+                          "total": group['total'], "pages_total": group['pages_total'],
+                          "windows": len(group['windows']), "pages_skipped": group['pages_skipped'],
+                          "journal_reset": group['journal_reset']})
+
+            self._run_bounded(
+                pool, count_queue,
+                lambda w: pool.submit(self._fetch_total, w['hs'], w['direction'], w['start_date'], w['end_date'], w['keyword']),
+                on_total
+            )
+
+            if self.cancelled():
+                stats['cancelled'] = True
+                return stats
+
+            # 点数预算：按精确的待下载记录数估算本次消耗，超出预算则不开始下载
+            stats['projected_credits'] = sum(
+                self._todo_records(w) for g in groups for w in g['windows']
+            ) * config.CREDITS_PER_RECORD
+            if self.credit_budget is not None and stats['projected_credits'] > self.credit_budget:
+                stats['over_budget'] = True
+                emit({"type": "over_budget", "projected_credits": stats['projected_credits'], "budget": self.credit_budget})
+                return stats
+
+            for group in groups:
+                if group['pages_done'] >= group['pages_total']: self._finish_slice(group, emit)
+
+            # 阶段 2：所有未完成页码作为独立任务送入流水线 (按组合、窗口顺序，先完成的组合先结束)
+            page_items = collections.deque(
+                (window, page) for group in groups for window in group['windows'] for page in window['todo_pages']
+            )
+            window_by_ticket = {
+                (w['hs'], w['direction'], w['start_date'], w['end_date'], w['keyword']): w for g in groups for w in g['windows']
+            }
+
+            def submit_page(item):
+                window, page = item
+                group = window['group']
+                if group['started_at'] is None: group['started_at'] = time.time()
+                return pool.submit(self._fetch_page, window['hs'], window['direction'], window['start_date'], window['end_date'], window['keyword'], page)
+
+            def complete_page(window, page, saved=0, error=None, failed_ids=None):
+                """一页结束 (写库完成或失败)，在调度线程中汇总并回调。"""
+                group = window['group']
+                window['pages_done'] += 1
+                group['pages_done'] += 1
+                group['pages_fetched'] += 1
+                event = {"hs": group['hs'], "direction": group['direction'], "page": page,
+                         "start_date": window['start_date'], "end_date": window['end_date'], "keyword": window['keyword'],
+                         "pages_done": group['pages_done'], "pages_total": group['pages_total']}
+                if error is None:
+                    stats['pages'] += 1
+                    stats['saved'] += saved
+                    group['saved'] += saved
+                    emit(dict(event, type="page", api_count=window['api_counts'].pop(page, 0), saved=saved,
+                              eta_seconds=self._eta_seconds(group)))
+                else:
+                    stats['errors'] += 1
+                    group['errors'] += 1
+                    emit(dict(event, type="error", msg=error, failed_ids=failed_ids or [],
+                              api_count=window['api_counts'].pop(page, 0)))
+                if group['pages_done'] >= group['pages_total']:
+                    self._finish_slice(group, emit)
+
+            # Normalize / Write 阶段的结果都经由该队列回到调度线程
+            finished = queue.Queue()
+
+            def on_ticket_done(ticket, saved, failed_ids):
+                # 写缓冲回调发生在 flush 线程：先登记任务日志 (尽早落盘)
+                window, page = window_by_ticket[ticket[:5]], ticket[5]
+                if failed_ids: self._forget_ids(failed_ids)
+                if self.journal and window['key'] and not failed_ids:
+                    self.journal.mark_page_done(window['key'], page, saved)
+                error = f"DB write failed: {len(failed_ids)} records not persisted" if failed_ids else None
+                finished.put((window, page, saved, error, failed_ids))
+
+            def on_normalize_failed(window, page, msg):
+                finished.put((window, page, 0, msg, []))
+
+            last_metrics = {"at": 0.0}
+
+            def on_tick():
+                while True:
+                    try:
+                        window, page, saved, error, failed_ids = finished.get_nowait()
+                    except queue.Empty:
+                        break
+                    complete_page(window, page, saved, error=error, failed_ids=failed_ids)
+                if time.time() - last_metrics['at'] >= config.PIPELINE_METRICS_INTERVAL:
+                    last_metrics['at'] = time.time()
+                    emit({"type": "metrics", "stages": self.metrics_snapshot()})
+
+            def on_fetched(item, result):
+                window, page = item
+                if result['ok']:
+                    # 队列满时阻塞调度线程，暂停派发新的 API 请求 (背压)
+                    ticket = (window['hs'], window['direction'], window['start_date'], window['end_date'], window['keyword'], page)
+                    self._normalize_q.put((ticket, result['res'], window))
+                else:
+                    complete_page(window, page, error=result['msg'])
+
+            self._normalize_q = queue.Queue(maxsize=config.PIPELINE_NORMALIZE_QUEUE)
+            self._seen_ids, self._duplicates = set(), 0
+            self._writer = write_buffer.WriteBuffer(on_ticket_done=on_ticket_done)
+            normalizers = [
+                threading.Thread(target=self._normalize_loop, args=(on_normalize_failed,), name=f"normalize-{i}", daemon=True)
+                for i in range(max(1, config.PIPELINE_NORMALIZE_WORKERS))
+            ]
+            for t in normalizers: t.start()
+            try:
+                self._run_bounded(pool, page_items, submit_page, on_fetched, on_tick=on_tick)
+            finally:
+                for _ in normalizers: self._normalize_q.put(_STOP)
+                for t in normalizers: t.join()
+                writer_stats = self._writer.close()
+            last_metrics['at'] = 0.0
+            on_tick()
+            stats['failed_ids'] = writer_stats['failed_ids']
+            stats['db_retries'] = writer_stats['retries']
+            stats['duplicates'] = self._duplicates
+        # 取消请求到达时所有页都已结束，则视为正常完成
+        stats['cancelled'] = self.cancelled() and any(g['pages_done'] < g['pages_total'] for g in groups)
+        return stats
@@ -0,0 +1,286 @@
+# ingest_worker.py
+# 后台下载 Worker：下载任务由进程级线程池持有，与 Streamlit 脚本运行 (浏览器会话) 解耦。
+# 页面只通过 submit / status / cancel 提交和轮询任务，刷新页面或操作控件不会中断下载；
+# 多个用户提交的任务在服务端排队执行直至完成。
+
+import collections
+import itertools
+import threading
+import time
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+import config
+import utils
+import downloader
+import job_journal
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+JOB_OVER_BUDGET = "over budget"
+FINISHED_STATES = (JOB_DONE, JOB_CANCELLED, JOB_FAILED, JOB_OVER_BUDGET)
+
+
+class IngestWorker:
+    """持有下载任务的后台线程池。所有公开方法都是线程安全的。"""
+
+    def __init__(self, max_jobs=None, history=None):
+        self._pool = ThreadPoolExecutor(max_workers=max_jobs or config.INGEST_MAX_CONCURRENT_JOBS, thread_name_prefix="ingest-job")
+        self._history = history or config.INGEST_JOB_HISTORY
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        self._metering = set()  # 处于前后余额快照之间的 job_id (用于识别余额差被多个任务共享)
+
+    # --- 对外接口 ---
+    def submit(self, token, hs_codes, directions, start_date, end_date, origin_codes=None, dest_codes=None,
+               keyword=None, max_in_flight=None, use_journal=True, sync_to_today=False, planned_slices=None, keywords=None, credit_budget=None, label=None):
+        """
+        提交一个下载任务，立即返回 job_id。
+        sync_to_today=True 时为增量同步：每个 (HS, 方向) 从各自高水位的次日下载到今天，
+        从未同步过的组合从 start_date 开始 (end_date 被忽略)。
+        planned_slices: 覆盖率规划 (coverage_planner.plan_slices) 得到的 (HS, 方向, start, end, keyword) 列表，
+        只下载这些窗口；计划中没有窗口的 (HS, 方向) 视为本地已完整。
+        keywords: 多树种扇出时每个树种一个关键词，各自独立请求后合并去重；keyword 则作为这组关键词的筛选标识。
+        credit_budget: 本任务允许消耗的点数上限 (None 取 config.CREDIT_BUDGET_PER_JOB，0 为不限)；
+        计数完成后预计消耗超过预算或当前余额时，任务不开始下载，状态为 over budget。
+        """
+        slices = downloader.build_slices(hs_codes, directions)
+        created_at = time.time()
+        with self._lock:
+            job_id = next(self._ids)
+            self._jobs[job_id] = {
+                "id": job_id, "job_ref": f"{int(created_at)}-{job_id}",
+                "label": label or f"{len(hs_codes)} HS × {len(directions)} flows",
+                "state": JOB_QUEUED,
+                "params": {
+                    "token": token, "hs_codes": list(hs_codes), "directions": list(directions), "slices": slices,
+                    "start_date": start_date, "end_date": end_date,
+                    "origin_codes": list(origin_codes or []), "dest_codes": list(dest_codes or []),
+                    "keyword": keyword, "keywords": list(keywords) if keywords else None, "max_in_flight": max_in_flight, "use_journal": use_journal,
+                    "sync_to_today": sync_to_today,
+                    "planned_slices": list(planned_slices) if planned_slices is not None else None,
+                    "credit_budget": config.CREDIT_BUDGET_PER_JOB if credit_budget is None else credit_budget,
+                },
+                "cancel_event": threading.Event(),
+                "created_at": created_at, "started_at": None, "finished_at": None,
+                "slices_done": 0, "slices_total": len(slices),
+                "tasks": collections.OrderedDict(
+                    ((hs, d), {"HS Code": hs, "Flow": d, "API Total": None, "Windows": None, "Pages": None, "Done": 0, "Saved": 0, "ETA": "-"})
+                    for hs, d in slices
+                ),
+                "log": collections.deque(maxlen=config.INGEST_JOB_LOG_LINES),
+                "stats": None,
+                "metrics": [],
+                "error": None,
+                "cost": {"balance_before": None, "balance_after": None, "spent": None, "shared_with": [],
+                         "estimated": 0, "records": 0, "projected": None, "budget": None},
+            }
+            self._prune()
+        self._pool.submit(self._run_job, job_id)
+        return job_id
+
+    def status(self, job_id):
+        """返回任务快照 (可安全在页面中渲染)；不存在时返回 None。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None: return None
+            return self._snapshot(job)
+
+    def list_jobs(self):
+        """所有任务的快照，最新的在前。"""
+        with self._lock:
+            return [self._snapshot(job) for job in reversed(self._jobs.values())]
+
+    def cancel(self, job_id):
+        """请求取消任务：排队中的直接取消，运行中的在途请求结束后停止。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['state'] in FINISHED_STATES: return False
+            job['cancel_event'].set()
+            if job['state'] == JOB_QUEUED:
+                job['state'] = JOB_CANCELLED
+                job['finished_at'] = time.time()
+            return True
+
+    # --- 内部实现 ---
+    def _snapshot(self, job):
+        return {
+            "id": job['id'], "label": job['label'], "state": job['state'],
+            "created_at": job['created_at'], "started_at": job['started_at'], "finished_at": job['finished_at'],
+            "slices_done": job['slices_done'], "slices_total": job['slices_total'],
+            "start_date": job['params']['start_date'], "end_date": job['params']['end_date'],
+            "keyword": job['params']['keyword'], "sync_to_today": job['params']['sync_to_today'],
+            "tasks": [dict(row) for row in job['tasks'].values()],
+            "log": list(job['log']),
+            "stats": dict(job['stats']) if job['stats'] else None,
+            "metrics": [dict(row) for row in job['metrics']],
+            "error": job['error'],
+            "job_ref": job['job_ref'], "cost": dict(job['cost'], shared_with=list(job['cost']['shared_with'])),
+        }
+
+    def _prune(self):
+        """只保留最近 history 个已结束的任务。"""
+        finished = [jid for jid, job in self._jobs.items() if job['state'] in FINISHED_STATES]
+        for jid in finished[:max(0, len(finished) - self._history)]:
+            del self._jobs[jid]
+
+    def _log(self, job, level, msg):
+        job['log'].append((level, msg))
+
+    def _run_job(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['state'] != JOB_QUEUED: return
+            job['state'] = JOB_RUNNING
+            job['started_at'] = time.time()
+            params = job['params']
+
+        try:
+            journal = job_journal.get_job_journal()
+            slices = params['slices']
+            if params['sync_to_today']:
+                slices, up_to_date = downloader.plan_incremental_slices(
+                    journal, params['hs_codes'], params['directions'], params['start_date'], date.today(),
+                    params['origin_codes'], params['dest_codes'], params['keyword']
+                )
+                with self._lock:
+                    for hs, d, last_date in up_to_date:
+                        job['tasks'][(hs, d)]['ETA'] = "✅"
+                        job['slices_done'] += 1
+                        self._log(job, "info", f"🔁 HS {hs} ({d}): already synced to {last_date} (已是最新)")
+                    for hs, d, start, end in slices:
+                        self._log(job, "write", f"🔁 HS {hs} ({d}): incremental sync {start} ~ {end}")
+            elif params['planned_slices'] is not None:
+                slices = params['planned_slices']
+                planned = {(item[0], item[1]) for item in slices}
+                with self._lock:
+                    for hs, d in params['slices']:
+                        if (hs, d) not in planned:
+                            job['tasks'][(hs, d)]['ETA'] = "✅"
+                            job['slices_done'] += 1
+                            self._log(job, "info", f"📐 HS {hs} ({d}): complete locally, skipped (本地已完整)")
+                    for hs, d, start, end, kw in slices:
+                        self._log(job, "write", f"📐 HS {hs} ({d}){keyword_suffix(kw)}: planned window {start} ~ {end}")
+
+            # 任务前余额快照；预算取配置预算与当前余额中较小者
+            balance_before = utils.get_account_balance()
+            budget = params['credit_budget'] or None
+            if balance_before is not None: budget = balance_before if budget is None else min(budget, balance_before)
+            with self._lock:
+                job['cost']['balance_before'] = balance_before
+                job['cost']['budget'] = budget
+                # 与同时在计量的任务互相登记：它们的前后余额差包含彼此的消耗，不能作为各自的实际消耗
+                for other_id in self._metering:
+                    other = self._jobs.get(other_id)
+                    if other is None: continue
+                    other['cost']['shared_with'].append(job['job_ref'])
+                    job['cost']['shared_with'].append(other['job_ref'])
+                self._metering.add(job_id)
+
+            engine = downloader.DownloadEngine(
+                params['token'], params['start_date'], params['end_date'],
+                params['origin_codes'], params['dest_codes'], keyword=params['keyword'],
+                max_in_flight=params['max_in_flight'],
+                journal=journal if params['use_journal'] else None,
+                cancel_event=job['cancel_event'], watermarks=journal, keywords=params['keywords'],
+                credit_budget=budget,
+            )
+            stats = engine.run(slices, on_event=lambda event: self._on_event(job, event, journal))
+
+            # 任务后余额快照：实际消耗 = 前后余额差；期间有其他任务也在运行时余额差是共享的，不记为本任务消耗
+            balance_after = utils.get_account_balance() if not stats['over_budget'] else balance_before
+            with self._lock:
+                self._metering.discard(job_id)
+                job['stats'] = stats
+                job['state'] = JOB_OVER_BUDGET if stats['over_budget'] else JOB_CANCELLED if stats['cancelled'] else JOB_DONE
+                cost = job['cost']
+                cost['projected'] = stats['projected_credits']
+                cost['balance_after'] = balance_after
+                cost['spent'] = journal.record_job_cost(
+                    job['job_ref'], job['label'], job['state'], balance_before, balance_after,
+                    cost['estimated'], cost['records'], job['started_at'], time.time(), shared_with=cost['shared_with']
+                )
+                if cost['shared_with']:
+                    self._log(job, "info", f"💳 Balance change shared with overlapping jobs {', '.join(cost['shared_with'])} — "
+                                           f"per-job cost unavailable, estimated {cost['estimated']:,.0f} (与其他任务同时运行，无法单独计量)")
+                elif cost['spent'] is not None:
+                    per_record = f", {cost['spent'] / cost['records']:.2f} credits/record" if cost['records'] else ""
+                    self._log(job, "info", f"💳 Credits spent (消耗点数): {cost['spent']:,.0f} (estimated {cost['estimated']:,.0f}{per_record})")
+                self._log(job, "success", f"🎉 Total Saved (累计入库): {stats['saved']} records")
+                if stats['duplicates']:
+                    self._log(job, "info", f"🔁 {stats['duplicates']} rows matched by more than one keyword / window were saved once (重复命中已去重)")
+                if stats['failed_ids']:
+                    self._log(job, "error", f"⚠️ {len(stats['failed_ids'])} records failed to persist after {stats['db_retries']} DB retries")
+        except Exception as e:
+            with self._lock:
+                job['state'] = JOB_FAILED
+                job['error'] = str(e)
+                self._log(job, "error", f"❌ Job failed: {e}")
+        finally:
+            with self._lock:
+                self._metering.discard(job_id)
+                job['finished_at'] = time.time()
+
+    def _on_event(self, job, event, journal):
+        """把引擎事件汇总到任务状态 (在任务线程中调用)。"""
+        if event['type'] == 'metrics':
+            with self._lock:
+                job['metrics'] = event['stages']
+            return
+        if event['type'] == 'over_budget':
+            with self._lock:
+                self._log(job, "error", f"💳 Projected cost {event['projected_credits']:,.0f} credits exceeds budget {event['budget']:,.0f} — download not started (超出点数预算，未开始下载)")
+            return
+        if event['type'] in ('page', 'error') and event.get('api_count'):
+            # 已请求到数据的页 (无论写库是否成功) 都计入点数账本
+            credits = event['api_count'] * config.CREDITS_PER_RECORD
+            journal.record_page_cost(job['job_ref'], event['hs'], event['direction'], event['start_date'], event['end_date'],
+                                     event.get('keyword'), event['page'], event['api_count'], credits)
+            with self._lock:
+                job['cost']['estimated'] += credits
+                job['cost']['records'] += event['api_count']
+        hs, d = event['hs'], event['direction']
+        with self._lock:
+            row = job['tasks'][(hs, d)]
+            if event['type'] == 'split':
+                self._log(job, "write", f"✂️ HS {hs} ({d}){keyword_suffix(event.get('keyword'))} {event['start_date']} ~ {event['end_date']}: {event['total']} records, splitting date window")
+            elif event['type'] == 'planned':
+                row['API Total'] = event['total']; row['Windows'] = event['windows']; row['Pages'] = event['pages_total']; row['Done'] = event['pages_skipped']
+                self._log(job, "write", f"📋 HS {hs} ({d}): {event['total']} records → {event['windows']} windows, {event['pages_total']} pages")
+                if event['journal_reset']: self._log(job, "warning", f"♻️ HS {hs} ({d}): API total changed since last run, journal reset")
+                elif event['pages_skipped']: self._log(job, "info", f"⏭️ HS {hs} ({d}): Skipping {event['pages_skipped']} pages already downloaded")
+            elif event['type'] == 'page':
+                row['Done'] = event['pages_done']; row['Saved'] += event['saved']; row['ETA'] = format_eta(event['eta_seconds'])
+                self._log(job, "write", f"🔄 HS {hs} ({d}){keyword_suffix(event.get('keyword'))} {event['start_date']} ~ {event['end_date']} - P{event['page']}: Fetched {event['api_count']} records")
+            elif event['type'] == 'error':
+                if event.get('pages_done') is not None: row['Done'] = event['pages_done']
+                where = f"P{event['page']}" if event['page'] else "Count"
+                self._log(job, "error", f"HS {hs} ({d}){keyword_suffix(event.get('keyword'))} {event.get('start_date')} ~ {event.get('end_date')} - {where}: Error - {event['msg']}")
+                if event.get('failed_ids'):
+                    self._log(job, "error", f"Not persisted (未入库) IDs: {', '.join(str(x) for x in event['failed_ids'])}")
+            elif event['type'] == 'slice_done':
+                row['ETA'] = "✅" if not event['errors'] else "⚠️"
+                job['slices_done'] += 1
+                if event['saved'] > 0: self._log(job, "success", f"✅ HS {hs} ({d}) Done: Saved {event['saved']}")
+                else: self._log(job, "warning", f"HS {hs} ({d}): No Data")
+                if event.get('watermark'): self._log(job, "info", f"📌 HS {hs} ({d}): synced through {event['watermark']}")
+
+
+def keyword_suffix(keyword):
+    return f" [{keyword}]" if keyword else ""
+
+
+def format_eta(seconds):
+    if seconds is None: return "-"
+    m, s = divmod(int(seconds), 60)
+    return f"{m}m {s:02d}s"
+
+
+@st.cache_resource
+def get_ingest_worker():
+    """进程级共享的后台 Worker (所有浏览器会话共用同一个任务队列)。"""
+    return IngestWorker()
@@ -0,0 +1,246 @@
+# job_journal.py
+# 下载任务日志 (本地 SQLite)：记录每个已完成的 (HS, 方向, 日期范围, 筛选条件, 页码) 单元，
+# 用于断点续传——中断后重新执行同一任务时，只请求尚未完成的页，不重复消耗 API 点数。
+# 同一文件中还保存增量同步的高水位 (sync_watermarks)：每个 (HS, 方向, 筛选条件) 已完整入库的最后日期，
+# 以及点数账本：每页的估算消耗 (credit_ledger) 和每个任务前后的余额快照 (job_costs)。
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+import streamlit as st
+import config
+
+
+class JobJournal:
+    """线程安全的 SQLite 任务日志 (单连接 + 锁，工作线程可直接写入)。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS download_slices (
+                slice_key   TEXT PRIMARY KEY,
+                hs_code     TEXT,
+                direction   TEXT,
+                start_date  TEXT,
+                end_date    TEXT,
+                filters     TEXT,
+                total       INTEGER,
+                pages_total INTEGER,
+                updated_at  REAL
+            );
+            CREATE TABLE IF NOT EXISTS download_pages (
+                slice_key    TEXT,
+                page         INTEGER,
+                saved        INTEGER,
+                completed_at REAL,
+                PRIMARY KEY (slice_key, page)
+            );
+            CREATE TABLE IF NOT EXISTS sync_watermarks (
+                hs_code    TEXT,
+                direction  TEXT,
+                filters    TEXT,
+                first_date TEXT,
+                last_date  TEXT,
+                updated_at REAL,
+                PRIMARY KEY (hs_code, direction, filters)
+            );
+            CREATE TABLE IF NOT EXISTS credit_ledger (
+                job_ref     TEXT,
+                hs_code     TEXT,
+                direction   TEXT,
+                start_date  TEXT,
+                end_date    TEXT,
+                keyword     TEXT,
+                page        INTEGER,
+                records     INTEGER,
+                credits     REAL,
+                recorded_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_credit_ledger_job ON credit_ledger (job_ref);
+            CREATE TABLE IF NOT EXISTS job_costs (
+                job_ref           TEXT PRIMARY KEY,
+                label             TEXT,
+                state             TEXT,
+                balance_before    REAL,
+                balance_after     REAL,
+                spent             REAL,
+                estimated_credits REAL,
+                records           INTEGER,
+                started_at        REAL,
+                finished_at       REAL,
+                shared_with       TEXT
+            );
+        """)
+        # 旧版本创建的 job_costs 没有 shared_with 列
+        if "shared_with" not in {r[1] for r in self._conn.execute("PRAGMA table_info(job_costs)")}:
+            self._conn.execute("ALTER TABLE job_costs ADD COLUMN shared_with TEXT")
+        self._conn.commit()
+
+    @staticmethod
+    def filters_key(origin_codes=None, dest_codes=None, keyword=None):
+        """筛选条件的规范化 JSON (国家列表排序)，作为任务日志与高水位的一部分 key。"""
+        return json.dumps({
+            "origin": sorted(origin_codes or []),
+            "dest": sorted(dest_codes or []),
+            "keyword": keyword or "",
+        }, sort_keys=True)
+
+    @staticmethod
+    def slice_key(hs, direction, start_date, end_date, origin_codes=None, dest_codes=None, keyword=None):
+        """同一组查询条件始终得到同一个 key。"""
+        filters = JobJournal.filters_key(origin_codes, dest_codes, keyword)
+        raw = json.dumps([str(hs), direction, str(start_date), str(end_date), json.loads(filters)], sort_keys=True)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest(), filters
+
+    def plan_slice(self, key, hs, direction, start_date, end_date, filters, total, pages_total):
+        """
+        登记 (或更新) 一个切片的 total，并返回已完成的页码集合。
+        如果 API 的 total 与上次记录不同，页边界已经移动，旧的页记录作废，该切片从头下载。
+        返回 (done_pages: set, was_reset: bool)
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT total FROM download_slices WHERE slice_key = ?", (key,)).fetchone()
+            was_reset = row is not None and row[0] != total
+            if was_reset:
+                self._conn.execute("DELETE FROM download_pages WHERE slice_key = ?", (key,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO download_slices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, str(hs), direction, str(start_date), str(end_date), filters, total, pages_total, time.time())
+            )
+            self._conn.commit()
+            done = self._conn.execute("SELECT page FROM download_pages WHERE slice_key = ?", (key,)).fetchall()
+        return {r[0] for r in done}, was_reset
+
+    def mark_page_done(self, key, page, saved):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO download_pages VALUES (?, ?, ?, ?)",
+                (key, page, saved, time.time())
+            )
+            self._conn.commit()
+
+    def slice_keys_in_range(self, hs, direction, start_date, end_date, origin_codes=None, dest_codes=None, keyword=None):
+        """
+        同一 (HS, 方向, 筛选条件) 下、日期落在 [start_date, end_date] 内的所有已登记切片 key。
+        下载引擎会把深窗口二分、覆盖率规划会按窗口下载，实际登记的切片不一定是完整的日期范围。
+        """
+        filters = self.filters_key(origin_codes, dest_codes, keyword)
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT slice_key FROM download_slices
+                WHERE hs_code = ? AND direction = ? AND filters = ? AND start_date >= ? AND end_date <= ?
+            """, (str(hs), direction, filters, str(start_date), str(end_date))).fetchall()
+        return [r[0] for r in rows]
+
+    def slice_progress(self, keys):
+        """返回 {key: (已完成页数, 总页数)}，未登记过的切片不出现在结果中。"""
+        if not keys: return {}
+        marks = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._conn.execute(f"""
+                SELECT s.slice_key, COUNT(p.page), s.pages_total
+                FROM download_slices s LEFT JOIN download_pages p ON p.slice_key = s.slice_key
+                WHERE s.slice_key IN ({marks})
+                GROUP BY s.slice_key
+            """, list(keys)).fetchall()
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def reset_slices(self, keys):
+        if not keys: return
+        marks = ",".join("?" * len(keys))
+        with self._lock:
+            self._conn.execute(f"DELETE FROM download_pages WHERE slice_key IN ({marks})", list(keys))
+            self._conn.execute(f"DELETE FROM download_slices WHERE slice_key IN ({marks})", list(keys))
+            self._conn.commit()
+
+    # --- 增量同步高水位 ---
+    def get_watermark(self, hs, direction, origin_codes=None, dest_codes=None, keyword=None):
+        """返回 (first_date, last_date)，均为 date；从未完整同步过时返回 None。"""
+        filters = self.filters_key(origin_codes, dest_codes, keyword)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT first_date, last_date FROM sync_watermarks WHERE hs_code = ? AND direction = ? AND filters = ?",
+                (str(hs), direction, filters)
+            ).fetchone()
+        if not row: return None
+        return date.fromisoformat(row[0]), date.fromisoformat(row[1])
+
+    def advance_watermark(self, hs, direction, start_date, end_date, origin_codes=None, dest_codes=None, keyword=None):
+        """
+        一个 (HS, 方向) 的日期范围完整入库后调用。
+        只有与已有覆盖区间重叠或相邻时才合并推进高水位，避免中间留下空洞。
+        返回推进后的 last_date (未推进则返回原值或 None)。
+        """
+        start_date, end_date = date.fromisoformat(str(start_date)[:10]), date.fromisoformat(str(end_date)[:10])
+        filters = self.filters_key(origin_codes, dest_codes, keyword)
+        current = self.get_watermark(hs, direction, origin_codes, dest_codes, keyword)
+        if current is None:
+            first_date, last_date = start_date, end_date
+        elif start_date <= current[1] + timedelta(days=1) and end_date >= current[0] - timedelta(days=1):
+            first_date, last_date = min(current[0], start_date), max(current[1], end_date)
+        else:
+            return current[1]
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_watermarks VALUES (?, ?, ?, ?, ?, ?)",
+                (str(hs), direction, filters, str(first_date), str(last_date), time.time())
+            )
+            self._conn.commit()
+        return last_date
+
+    # --- 点数账本 ---
+    def record_page_cost(self, job_ref, hs, direction, start_date, end_date, keyword, page, records, credits):
+        """登记一页请求的估算消耗 (API 返回的记录数 × 每条点数)。"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO credit_ledger VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_ref, str(hs), direction, str(start_date), str(end_date), keyword or "", page, records, credits, time.time())
+            )
+            self._conn.commit()
+
+    def job_cost_breakdown(self, job_ref):
+        """某个任务按 (HS, 方向) 汇总的页数、记录数与估算点数。"""
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT hs_code, direction, COUNT(*), SUM(records), SUM(credits)
+                FROM credit_ledger WHERE job_ref = ?
+                GROUP BY hs_code, direction ORDER BY hs_code, direction
+            """, (job_ref,)).fetchall()
+        return [{"HS Code": r[0], "Flow": r[1], "Pages": r[2], "Records": r[3], "Est. Credits": r[4]} for r in rows]
+
+    def record_job_cost(self, job_ref, label, state, balance_before, balance_after, estimated_credits, records, started_at, finished_at,
+                        shared_with=None):
+        """
+        任务结束后登记前后余额快照；余额任一侧取不到时 spent 为 None。
+        shared_with: 计量期间同时运行的其他任务 (job_ref 列表)；非空时余额差包含它们的消耗，spent 记为 None。
+        """
+        spent = balance_before - balance_after if balance_before is not None and balance_after is not None else None
+        if shared_with: spent = None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_costs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_ref, label, state, balance_before, balance_after, spent, estimated_credits, records, started_at, finished_at,
+                 ",".join(shared_with or []) or None)
+            )
+            self._conn.commit()
+        return spent
+
+    def recent_job_costs(self, limit=50):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM job_costs ORDER BY started_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        cols = ["job_ref", "label", "state", "balance_before", "balance_after", "spent", "estimated_credits", "records", "started_at", "finished_at", "shared_with"]
+        return [dict(zip(cols, r)) for r in rows]
+
+
+@st.cache_resource
+def get_job_journal():
+    """进程级共享的任务日志实例。"""
+    return JobJournal(config.JOB_JOURNAL_PATH)
@@ -0,0 +1,239 @@
+# mock_tendata.py
+# 本地 Tendata 模拟服务 (离线压测 / 基准测试用)，实现 /v2/access-token、/v2/account、/v2/trade。
+# 数据可以是合成的 (按 HS × 方向 × 日期确定性生成，同一查询每次返回相同记录，日期窗口拆分后总数一致)，
+# 也可以是录制的 (--fixtures 指向 JSONL 文件，每行一条 API 原始记录，可带 "_catalog": "imports"/"exports")。
+#
+# 用法：
+#   python mock_tendata.py --port 8765 --latency 0.2 --error-rate 0.05 --token-ttl 600
+#   然后在 config.py 中设置 TENDATA_BASE_URL = "http://127.0.0.1:8765"
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import config
+
+ORIGINS = ["NZ", "US", "CA", "CL", "RU", "DE", "BR", "UY", "FI", "SE"]
+DESTS = ["CN", "IN", "VN", "JP", "KR", "US", "DE", "TH", "MY", "ID"]
+PORTS = ["TAURANGA", "NAPIER", "LYTTELTON", "QINGDAO", "LIANYUNGANG", "KANDLA", "VIZAG", "HAIPHONG"]
+
+
+class MockState:
+    """服务端状态：已签发的 Token、请求计数与账户余额 (线程安全)。"""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.tokens = {}        # token -> [expires_at, 已服务的 trade 请求数]
+        self.balance = options.balance
+        self.requests = 0
+        self.fixtures = load_fixtures(options.fixtures) if options.fixtures else None
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = [time.time() + self.options.token_ttl, 0]
+        return token
+
+    def check_token(self, token, count_request=False):
+        """Token 有效返回 True；过期、未知或达到 --expire-after 次请求时返回 False (对应 40302)。"""
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is None or time.time() >= entry[0]: return False
+            if count_request:
+                entry[1] += 1
+                if self.options.expire_after and entry[1] > self.options.expire_after:
+                    entry[0] = 0
+                    return False
+            return True
+
+    def charge(self, records):
+        with self.lock:
+            self.balance -= records * config.CREDITS_PER_RECORD
+
+
+def load_fixtures(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _seed(*parts):
+    return int(hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:12], 16)
+
+
+def synthetic_day(hs, catalog, day, records_per_day):
+    """某个 HS × 方向 × 日期的合成记录 (确定性生成，数量在 records_per_day 的 50% ~ 150% 之间)。"""
+    rng = random.Random(_seed(hs, catalog, day))
+    count = int(records_per_day * rng.uniform(0.5, 1.5))
+    species = list(config.SPECIES_KEYWORDS.items())
+    records = []
+    for i in range(count):
+        name, keywords = species[rng.randrange(len(species))]
+        records.append({
+            "id": hashlib.sha1(f"{hs}|{catalog}|{day}|{i}".encode("utf-8")).hexdigest()[:20],
+            "date": str(day),
+            "hsCode": [hs],
+            "goodsDesc": [f"{keywords[0]} {name.upper()} SAWN TIMBER"],
+            "countryOfOriginCode": ORIGINS[rng.randrange(len(ORIGINS))],
+            "countryOfDestinationCode": DESTS[rng.randrange(len(DESTS))],
+            "portOfDeparture": PORTS[rng.randrange(3)],
+            "portOfArrival": PORTS[3 + rng.randrange(len(PORTS) - 3)],
+            "importer": f"IMPORTER {rng.randrange(200):03d} CO LTD",
+            "exporter": f"EXPORTER {rng.randrange(120):03d} LTD",
+            "quantity": round(rng.uniform(5, 500), 2),
+            "quantityUnit": "M3",
+            "sumOfUsd": round(rng.uniform(1000, 150000), 2),
+        })
+    return records
+
+
+def query_records(state, payload):
+    """按请求条件筛选记录 (合成或录制)，返回按日期排序的完整结果列表。"""
+    hs = str(payload.get("hsCode") or "")
+    catalog = payload.get("catalog") or "imports"
+    start = date.fromisoformat(str(payload.get("startDate"))[:10])
+    end = date.fromisoformat(str(payload.get("endDate"))[:10])
+    origins = set(filter(None, str(payload.get("countryOfOriginCode") or "").split(";")))
+    dests = set(filter(None, str(payload.get("countryOfDestinationCode") or "").split(";")))
+    keyword = str(payload.get("keyword") or payload.get("goodsDesc") or "").upper()
+
+    if state.fixtures is not None:
+        candidates = [
+            r for r in state.fixtures
+            if start <= date.fromisoformat(str(r.get("date"))[:10]) <= end
+            and any(str(code).startswith(hs) for code in (r.get("hsCode") or []))
+            and r.get("_catalog", catalog) == catalog
+        ]
+        candidates.sort(key=lambda r: (str(r.get("date")), str(r.get("id"))))
+    else:
+        candidates = []
+        day = start
+        while day <= end:
+            candidates.extend(synthetic_day(hs, catalog, day, state.options.records_per_day))
+            day += timedelta(days=1)
+
+    return [
+        r for r in candidates
+        if (not origins or r.get("countryOfOriginCode") in origins)
+        and (not dests or r.get("countryOfDestinationCode") in dests)
+        and (not keyword or keyword in " ".join(str(x) for x in (r.get("goodsDesc") or [])).upper())
+    ]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        if not self.state.options.quiet:
+            super().log_message(format, *args)
+
+    def _send(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _simulate_network(self):
+        """模拟延迟与故障；返回 True 表示本次请求已按故障处理。"""
+        options = self.state.options
+        with self.state.lock:
+            self.state.requests += 1
+        if options.latency or options.jitter:
+            time.sleep(max(0.0, options.latency + random.uniform(-options.jitter, options.jitter)))
+        roll = random.random()
+        if roll < options.error_rate:
+            self._send({"code": 503, "msg": "mock: service unavailable"}, status=503)
+            return True
+        if roll < options.error_rate + options.throttle_rate:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return True
+        return False
+
+    def _bearer(self):
+        auth = self.headers.get("Authorization") or ""
+        return auth[7:] if auth.startswith("Bearer ") else ""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if self._simulate_network(): return
+        if url.path == "/v2/access-token":
+            api_key = (parse_qs(url.query).get("apiKey") or [""])[0]
+            if not api_key:
+                return self._send({"code": 40101, "msg": "mock: missing apiKey"})
+            return self._send({"code": 200, "data": {
+                "accessToken": self.state.issue_token(), "expiresIn": self.state.options.token_ttl,
+            }})
+        if url.path == "/v2/account":
+            if not self.state.check_token(self._bearer()):
+                return self._send({"code": 40302, "msg": "mock: access token invalid"})
+            return self._send({"code": 200, "data": {
+                "balance": int(self.state.balance), "expiresIn": "2099-12-31 23:59:59",
+            }})
+        self._send({"code": 404, "msg": f"mock: unknown path {url.path}"}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self._simulate_network(): return
+        if url.path != "/v2/trade":
+            return self._send({"code": 404, "msg": f"mock: unknown path {url.path}"}, status=404)
+        if not self.state.check_token(self._bearer(), count_request=True):
+            return self._send({"code": 40302, "msg": "mock: access token invalid"})
+        if self.headers.get("Content-Encoding") == "gzip": raw = gzip.decompress(raw)
+        payload = json.loads(raw or b"{}")
+
+        records = query_records(self.state, payload)
+        page_no = max(1, int(payload.get("pageNo") or 1))
+        page_size = max(1, int(payload.get("pageSize") or 20))
+        total = len(records) if self.state.options.max_total is None else min(len(records), self.state.options.max_total)
+        content = records[(page_no - 1) * page_size:min(page_no * page_size, total)]
+        self.state.charge(len(content))
+        self._send({"code": 200, "data": {"total": total, "content": content}})
+
+
+def build_server(options):
+    handler = type("BoundMockHandler", (MockHandler,), {"state": MockState(options)})
+    return ThreadingHTTPServer((options.host, options.port), handler)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local Tendata API stand-in for offline load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的固定延迟 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机抖动 (± 秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 HTTP 503 的概率")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 HTTP 429 的概率")
+    parser.add_argument("--token-ttl", type=int, default=7200, help="Access Token 有效期 (秒)")
+    parser.add_argument("--expire-after", type=int, default=0, help="每个 Token 服务多少次 trade 请求后返回 40302 (0 = 不限)")
+    parser.add_argument("--records-per-day", type=int, default=40, help="合成数据：每个 HS × 方向每天的平均记录数")
+    parser.add_argument("--max-total", type=int, default=None, help="单次查询 total 的上限 (模拟 API 截断)")
+    parser.add_argument("--balance", type=float, default=1_000_000, help="初始账户点数")
+    parser.add_argument("--fixtures", default=None, help="录制的记录 (JSONL)，指定后不再生成合成数据")
+    parser.add_argument("--quiet", action="store_true", help="不打印访问日志")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    opts = parse_args()
+    server = build_server(opts)
+    print(f"Mock Tendata listening on http://{opts.host}:{opts.port} (set config.TENDATA_BASE_URL to this)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
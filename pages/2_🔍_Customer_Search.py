@@ -67,8 +67,8 @@ with st.sidebar:
     selected_cat_sidebar = st.selectbox("Product Group (全局产品分类)", ["All (全部)"] + sorted_cats_global)
     st.info(f"💡 提示：此处筛选仅用于缩小下方搜索框的公司列表。")
     st.divider()
-    if 'token_expiry' in st.session_state:
-        remaining_min = int((st.session_state['token_expiry'] - pd.Timestamp.now().timestamp()) / 60)
+    if utils.get_token_expiry():
+        remaining_min = int((utils.get_token_expiry() - pd.Timestamp.now().timestamp()) / 60)
         if remaining_min > 0: st.caption(f"✅ API Token Active ({remaining_min} min)")
         else: st.caption("⚠️ API Token Expired")
 
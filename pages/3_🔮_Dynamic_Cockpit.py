@@ -46,63 +46,15 @@ df_raw = st.session_state['analysis_df'].copy()
 df_raw['quantity'] = pd.to_numeric(df_raw['quantity'], errors='coerce').fillna(0)
 df_raw['total_value_usd'] = pd.to_numeric(df_raw['total_value_usd'], errors='coerce').fillna(0)
 
-# 3.2 港口清洗
-def clean_port_name(val):
-    s = str(val).strip()
-    if '(' in s: return s.split('(')[-1].replace(')', '').strip()
-    return s
-
-df_raw['port_of_arrival'] = df_raw['port_of_arrival'].fillna('Unknown').apply(clean_port_name)
-if 'port_of_departure' in df_raw.columns:
-    df_raw['port_of_departure'] = df_raw['port_of_departure'].fillna('Unknown').apply(clean_port_name)
-else:
-    df_raw['port_of_departure'] = 'Unknown'
-
-name_fix_map = {
-    "VIZAG": "Visakhapatnam", "VIZAG SEA": "Visakhapatnam",
-    "GOA": "Mormugao (Goa)", "GOA PORT": "Mormugao (Goa)"
-}
-df_raw['port_of_arrival'] = df_raw['port_of_arrival'].replace(name_fix_map)
-if hasattr(config, 'PORT_CODE_TO_NAME'):
-    df_raw['port_of_arrival'] = df_raw['port_of_arrival'].replace(config.PORT_CODE_TO_NAME)
+# 3.2 派生列：港口清洗、树种识别、国家名称、产品分类
+# 首页加载时已由 utils.enrich_frame 整理 (优先使用入库时计算的派生列)，这里只兜底旧的缓存数据
+if not df_raw.attrs.get('enriched'):
+    df_raw = utils.enrich_frame(df_raw)
 
 # 3.3 日期处理
 df_raw['transaction_date'] = pd.to_datetime(df_raw['transaction_date'])
 df_raw['Month'] = df_raw['transaction_date'].dt.to_period('M').astype(str)
 
-# 3.4 树种识别
-if 'Species' not in df_raw.columns:
-    if 'product_desc_text' in df_raw.columns:
-        df_raw['Species'] = df_raw['product_desc_text'].apply(utils.identify_species)
-    else:
-        df_raw['Species'] = 'Unknown'
-
-# 3.5 国家名称映射
-def get_country_name_en(code):
-    if pd.isna(code) or code == "" or code is None: return "Unknown"
-    full_name = config.COUNTRY_NAME_MAP.get(code, code)
-    full_name_str = str(full_name)
-    if '(' in full_name_str: return full_name_str.split(' (')[0]
-    return full_name_str
-
-if 'origin_name' not in df_raw.columns:
-    df_raw['origin_name'] = df_raw['origin_country_code'].apply(get_country_name_en)
-if 'dest_name' not in df_raw.columns:
-    df_raw['dest_name'] = df_raw['dest_country_code'].apply(get_country_name_en)
-
-# 3.6 产品分类映射
-def map_hs_to_category(hs_code):
-    hs_str = str(hs_code)
-    if hasattr(config, 'HS_CODES_MAP'):
-        for category, codes in config.HS_CODES_MAP.items():
-            for c in codes:
-                if hs_str.startswith(c):
-                    return category
-    return "Other Products"
-
-if 'Product_Category' not in df_raw.columns:
-    df_raw['Product_Category'] = df_raw['hs_code'].apply(map_hs_to_category)
-
 # ==========================================
 # 4. 侧边栏筛选器 (Sidebar Filters)
 # ==========================================
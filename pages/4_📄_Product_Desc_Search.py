@@ -1,7 +1,6 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import config
 import utils
 
 # --- 1. 页面配置 ---
@@ -19,30 +18,9 @@ if 'analysis_df' not in st.session_state or st.session_state['analysis_df'].empt
 # 获取数据副本
 df_raw = st.session_state['analysis_df'].copy()
 
-# 基础清洗：补全名称和树种
-def get_name_safe(code):
-    if not code: return "Unknown"
-    name = config.COUNTRY_NAME_MAP.get(code, code)
-    return str(name).split(' (')[0] if '(' in str(name) else str(name)
-
-# 动态映射 HS Code 到产品分类
-def map_hs_to_category(hs_code):
-    hs_str = str(hs_code)
-    if hasattr(config, 'HS_CODES_MAP'):
-        for category, codes in config.HS_CODES_MAP.items():
-            for c in codes:
-                if hs_str.startswith(c):
-                    return category
-    return "Other Products"
-
-if 'origin_name' not in df_raw.columns:
-    df_raw['origin_name'] = df_raw['origin_country_code'].apply(get_name_safe)
-if 'dest_name' not in df_raw.columns:
-    df_raw['dest_name'] = df_raw['dest_country_code'].apply(get_name_safe)
-if 'Species' not in df_raw.columns:
-    df_raw['Species'] = df_raw['product_desc_text'].apply(utils.identify_species)
-if 'Product_Category' not in df_raw.columns:
-    df_raw['Product_Category'] = df_raw['hs_code'].apply(map_hs_to_category)
+# 基础清洗：补全名称、树种和产品分类 (首页加载时已整理，这里只兜底旧的缓存数据)
+if not df_raw.attrs.get('enriched'):
+    df_raw = utils.enrich_frame(df_raw)
 
 # --- 3. 侧边栏：全局数据过滤 ---
 with st.sidebar:
@@ -3,12 +3,18 @@ import pandas as pd
 import time
 import plotly.express as px
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import config
 import utils # 引用公共库
+import downloader # 并发下载引擎
+import job_journal # 断点续传任务日志
+import ingest_worker # 后台下载 Worker
+import coverage_planner # 覆盖率规划
 
 st.set_page_config(page_title="Data Download / 批量下载", page_icon="🚀", layout="wide")
 
 st.title("🚀 Batch Download Center (批量下载中心)")
+utils.render_schema_notice()
 
 # 初始化状态
 if 'show_heatmap' not in st.session_state:
@@ -21,7 +27,7 @@ with st.sidebar:
     token = utils.get_auto_token()
     if token:
         # 简单计算剩余时间
-        expiry = st.session_state.get('token_expiry', time.time())
+        expiry = utils.get_token_expiry()
         remaining = int((expiry - time.time()) / 60)
         if remaining < 0: remaining = 0
         st.success(f"✅ API Connected (剩余 {remaining} min)")
@@ -57,18 +63,26 @@ final_dirs = selected_dirs if selected_dirs else ["imports", "exports"]
 
 # --- 关键词生成逻辑 ---
 api_keyword_str = None
+api_keywords = None  # 扇出模式：每个树种 (或同义词) 一路请求，合并去重后入库
 if dl_species:
-    kws = []
-    for s in dl_species:
-        if s in config.SPECIES_KEYWORDS:
-            kws.append(config.SPECIES_KEYWORDS[s][0])
-    
-    if len(kws) > 1:
+    kws = utils.species_keywords(dl_species)
+    c_kw1, c_kw2 = st.columns(2)
+    fan_out = len(kws) > 1 and c_kw1.checkbox("🔀 Fan-out per species (每个树种单独请求，合并去重)", value=True, key="dl_fan_out",
+                                            help="API 对多个关键词按 AND 处理；扇出模式对每个树种单独发请求并发执行，结果按 unique_record_id 去重后入库 (即并集)。")
+    use_synonyms = bool(kws) and c_kw2.checkbox("Include synonyms (包含同义词)", value=False, key="dl_synonyms",
+                                               help="每个同义词 (config.SPECIES_KEYWORDS) 也单独请求一路。")
+    if fan_out or use_synonyms:
+        api_keywords = utils.species_keywords(dl_species, synonyms=use_synonyms)
+        # 关键词组合的标识：用于任务日志、高水位和计划缓存
+        api_keyword_str = " | ".join(api_keywords)
+        st.success(f"🔀 Fan-out Active: {len(api_keywords)} keyword streams ({api_keyword_str}), merged & de-duplicated before upsert")
+    elif len(kws) > 1:
         api_keyword_str = " ".join(kws)
-        st.warning(f"⚠️ Multi-Species Filter: Searching for '{api_keyword_str}'. (API likely treats this as 'AND' logic. For volume check, recommend selecting ONE species at a time.)")
+        st.warning(f"⚠️ Multi-Species Filter: Searching for '{api_keyword_str}'. (API likely treats this as 'AND' logic. Enable fan-out to get the union.)")
     elif kws:
         api_keyword_str = kws[0]
         st.success(f"🧬 Species Filter Active: '{api_keyword_str}' (Will be applied to API requests)")
+stream_keywords = api_keywords or [api_keyword_str]
 
 st.divider()
 
@@ -157,75 +171,210 @@ st.markdown("#### 2️⃣ API Volume Check (API 预检)")
 
 dl_date_range = st.date_input("Date Range (下载日期范围)", value=(datetime.today() - timedelta(days=7), datetime.today()), key="dl_date_key")
 
+# 当前选择的签名：预检结果 / 下载计划只在选择未变化时有效
+plan_signature = (
+    tuple(final_hs), tuple(final_dirs), tuple(str(d) for d in dl_date_range),
+    tuple(sorted(dl_origins)), tuple(sorted(dl_dests)), api_keyword_str
+)
+
 if st.button("🔍 Check Volume (查询数据量)"):
     with st.status(f"Querying Tendata API... (Keyword: {api_keyword_str if api_keyword_str else 'None'})", expanded=True) as status:
         if not token: status.update(label="Auth Failed (认证失败)", state="error"); st.stop()
-        results = []
+        # 所有计数请求并发执行，每完成一个就刷新表格 (相同条件的计数在 TTL 内直接取缓存)
+        streams = [(hs, d, kw) for hs, d in downloader.build_slices(final_hs, final_dirs) for kw in stream_keywords]
+        results = {
+            (hs, d, kw): dict({"HS Code": hs, "Flow": d}, **({"Keyword": kw} if api_keywords else {}), **{"API Count": None, "Note": "⏳"})
+            for hs, d, kw in streams
+        }
+        table_slot = st.empty()
         total_count = 0
-        for hs in final_hs:
-            for d in final_dirs:
-                # 调用 utils, 传入 keyword
-                res = utils.fetch_tendata_api(hs, dl_date_range[0], dl_date_range[1], token, d, dl_origins, dl_dests, just_checking=True, keyword=api_keyword_str)
-                if res and str(res.get('code')) == '200':
-                    data_node = res.get('data', {})
-                    count = data_node.get('total', 0)
-                    if count == 0: count = data_node.get('totalElements', 0)
-                    results.append({"HS Code": hs, "Flow": d, "API Count": count})
-                    total_count += count
+        with ThreadPoolExecutor(max_workers=config.API_COUNT_MAX_WORKERS) as pool:
+            futures = {
+                pool.submit(utils.fetch_api_count, hs, dl_date_range[0], dl_date_range[1], token, d, dl_origins, dl_dests, keyword=kw): (hs, d, kw)
+                for hs, d, kw in streams
+            }
+            for fut in as_completed(futures):
+                row = results[futures[fut]]
+                count = fut.result()
+                if count['ok']:
+                    row['API Count'] = count['total']
+                    row['Note'] = "cached" if count['cached'] else ""
+                    total_count += count['total']
                 else:
                     # 显示具体的错误信息
-                    error_msg = res.get('msg', 'Unknown Error') if res else 'No Response'
-                    error_code = res.get('code', 'N/A') if res else 'N/A'
-                    results.append({"HS Code": hs, "Flow": d, "API Count": f"Err {error_code}: {error_msg}"})
-                    
+                    row['Note'] = f"Err {count['code']}: {count['msg']}"
+                table_slot.dataframe(pd.DataFrame(results.values()), use_container_width=True, hide_index=True)
+
         status.update(label="Complete (完成)", state="complete")
-        if results:
-            st.table(pd.DataFrame(results))
-            if total_count > 0: st.success(f"✅ Total found on API: {total_count} records.")
+        st.session_state['dl_volume'] = {"signature": plan_signature, "total": total_count}
+        if total_count > 0:
+            st.caption(f"💳 Projected cost (预计消耗): {total_count * config.CREDITS_PER_RECORD:,} credits")
+            if api_keywords: st.success(f"✅ Total found on API: up to {total_count} records (streams may overlap; duplicates are merged).")
+            else: st.success(f"✅ Total found on API: {total_count} records.")
+
+# --- 覆盖率规划：对比 API 与本地记录数，只下载缺失的窗口 ---
+if st.button("📐 Build Plan (生成下载计划)", help=f"按 {config.PLAN_WINDOW_DAYS} 天窗口对比 API 与本地数据库的记录数，本地已完整的窗口不再下载。"):
+    if not token:
+        st.error("Auth Failed (认证失败)")
+    elif len(dl_date_range) != 2:
+        st.error("请选择完整的下载日期范围")
+    else:
+        plan_bar = st.progress(0, text="Comparing API vs local counts (对比中)...")
+        plan = coverage_planner.build_plan(
+            token, final_hs, final_dirs, dl_date_range[0], dl_date_range[1], dl_origins, dl_dests, keyword=api_keyword_str,
+            keywords=api_keywords,
+            on_progress=lambda done, total: plan_bar.progress(int(done / total * 100), text=f"Comparing API vs local counts (对比中): {done}/{total}")
+        )
+        plan_bar.empty()
+        st.session_state['dl_plan'] = {"signature": plan_signature, "plan": plan}
+
+dl_plan = st.session_state.get('dl_plan')
+if dl_plan and dl_plan['signature'] != plan_signature:
+    st.caption("ℹ️ Selection changed since the last plan — rebuild to use it (筛选条件已变化，请重新生成计划)。")
+    dl_plan = None
+if dl_plan:
+    summary = coverage_planner.summarize_plan(dl_plan['plan'])
+    c_pl1, c_pl2, c_pl3, c_pl4 = st.columns(4)
+    c_pl1.metric("Windows to Download (需下载窗口)", f"{summary['windows_to_download']} / {summary['windows']}")
+    c_pl2.metric("Records to Fetch (需下载记录)", summary['records_to_fetch'])
+    c_pl3.metric("Pages Saved (节省页数)", summary['pages_saved'])
+    c_pl4.metric("Est. Credits Saved (预计节省点数)", summary['credits_saved'])
+    with st.expander("📐 Plan Detail (计划明细)"):
+        st.dataframe(pd.DataFrame([{
+            "HS Code": r['hs'], "Flow": r['direction'], "Keyword": r['keyword'] or "-", "From": str(r['start_date']), "To": str(r['end_date']),
+            "API Count": r['remote'], "Local Count": r['local'], "Action": r['action'], "Note": r['msg'],
+        } for r in dl_plan['plan']]), use_container_width=True, hide_index=True)
 
 # --- 3. 执行下载 (包含断点续传逻辑) ---
 st.markdown("#### 3️⃣ Execute Download (执行下载)")
 
-c_exec1, c_exec2 = st.columns([1, 4])
+journal = job_journal.get_job_journal()
+# 包括引擎二分出的子窗口和按计划下载的窗口 (只要落在所选日期范围内)
+journal_keys = [
+    key
+    for hs, d in downloader.build_slices(final_hs, final_dirs) for kw in stream_keywords
+    for key in journal.slice_keys_in_range(hs, d, dl_date_range[0], dl_date_range[1], dl_origins, dl_dests, kw)
+] if len(dl_date_range) == 2 else []
+journal_progress = journal.slice_progress(journal_keys)
+if journal_progress:
+    pages_done = sum(v[0] for v in journal_progress.values())
+    pages_total = sum(v[1] for v in journal_progress.values())
+    c_jr1, c_jr2 = st.columns([4, 1])
+    c_jr1.info(f"📒 Journal: {pages_done}/{pages_total} pages of this selection already downloaded — they will be skipped (断点续传)。")
+    if c_jr2.button("🧹 Reset Journal (重置)", help="清除当前筛选条件的下载记录，下次将从第 1 页重新下载。"):
+        journal.reset_slices(journal_keys)
+        st.rerun()
+
+# 增量同步高水位 (每个 HS × 方向 已完整入库的最后日期)
+with st.expander("📌 Sync Watermarks (增量同步高水位)"):
+    wm_rows = []
+    for hs, d in downloader.build_slices(final_hs, final_dirs):
+        mark = journal.get_watermark(hs, d, dl_origins, dl_dests, api_keyword_str)
+        wm_rows.append({"HS Code": hs, "Flow": d,
+                        "Synced From": str(mark[0]) if mark else "-", "Synced Through": str(mark[1]) if mark else "Never (从未同步)"})
+    st.dataframe(pd.DataFrame(wm_rows), use_container_width=True, hide_index=True)
+
+c_exec1, c_exec2, c_exec3 = st.columns([1, 1, 3])
 with c_exec1:
-    start_page_val = st.number_input("Start Page (起始页码)", min_value=1, value=1, help="用于断点续传。")
+    use_journal = st.checkbox("Resume (断点续传)", value=True, help="跳过任务日志中已完成的页，只下载缺失的页。")
+    sync_to_today = st.checkbox("🔁 Sync to Today (增量同步)", value=False, help="每个 HS × 方向 只下载其高水位之后到今天的数据；从未同步过的组合从所选开始日期下载。")
+    use_plan = st.checkbox("📐 Use Plan (只下载缺失窗口)", value=True, disabled=not dl_plan, help="按上方的下载计划执行，跳过本地已完整的窗口。与增量同步同时勾选时，以增量同步为准。")
 with c_exec2:
+    max_in_flight = st.number_input("Max In-Flight (并发请求数)", min_value=1, max_value=config.DOWNLOAD_MAX_IN_FLIGHT_LIMIT, value=config.DOWNLOAD_MAX_IN_FLIGHT, help="同时在途的 API 请求上限。")
+    credit_budget = st.number_input("Credit Budget (点数预算)", min_value=0, value=config.CREDIT_BUDGET_PER_JOB, step=1000,
+                                    help="本任务允许消耗的点数上限 (0 = 不限，仍受账户余额约束)。预计消耗超出时任务不会开始下载。")
+with c_exec3:
     st.write("") 
     st.write("") 
-    start_btn = st.button("🚀 Start Download (开始下载 - 自动翻页)", type="primary")
+    start_btn = st.button("🚀 Start Download (提交后台下载)", type="primary")
+
+worker = ingest_worker.get_ingest_worker()
+
+# 预检得到的预计消耗 (仅当预检与当前选择一致时)；后台任务在计数完成后还会按精确页数再检查一次
+dl_volume = st.session_state.get('dl_volume')
+projected_cost = dl_volume['total'] * config.CREDITS_PER_RECORD if dl_volume and dl_volume['signature'] == plan_signature else None
 
 if start_btn:
-    with st.status("Downloading... (下载中)", expanded=True) as status:
-        if not token: status.update(label="Auth Failed (认证失败)", state="error"); st.stop()
-        progress_bar = st.progress(0); log_box = st.expander("Process Log (运行日志)", expanded=True)
-        total_ops = len(final_hs) * len(final_dirs); current_op = 0; stats = {"saved": 0}
-        
-        for hs in final_hs:
-            for d in final_dirs:
-                current_op += 1; progress_bar.progress(int(current_op/total_ops*100))
-                
-                page = start_page_val
-                if page > 1:
-                    log_box.info(f"⏭️ Resuming {hs} ({d}) from Page {page}...")
-                
-                has_more_data = True
-                total_saved_for_this_hs = 0
-                
-                while has_more_data:
-                    res = utils.fetch_tendata_api(hs, dl_date_range[0], dl_date_range[1], token, d, dl_origins, dl_dests, just_checking=False, page_no=page, keyword=api_keyword_str)
-                    if res and str(res.get('code')) == '200':
-                        saved_count, api_count = utils.save_to_supabase(res) # 调用 utils
-                        total_saved_for_this_hs += saved_count
-                        stats['saved'] += saved_count
-                        log_box.write(f"🔄 HS {hs} ({d}) - P{page}: Fetched {api_count} records")
-                        if api_count < 50: has_more_data = False
-                        else: page += 1; time.sleep(0.3)
-                    else:
-                        err_msg = res.get('msg', 'Unknown') if res else 'No Resp'
-                        log_box.error(f"HS {hs}: Error - {err_msg}"); has_more_data = False
-                
-                if total_saved_for_this_hs > 0: log_box.success(f"✅ HS {hs} ({d}) Done: Saved {total_saved_for_this_hs}")
-                else: log_box.warning(f"HS {hs} ({d}): No Data")
-        
-        status.update(label="All Done (全部完成)", state="complete")
-        st.success(f"🎉 Total Saved (累计入库): {stats['saved']} records")
\ No newline at end of file
+    if not token:
+        st.error("Auth Failed (认证失败)")
+    elif len(dl_date_range) != 2:
+        st.error("请选择完整的下载日期范围")
+    elif projected_cost and credit_budget and projected_cost > credit_budget and not sync_to_today and not (dl_plan and use_plan):
+        st.error(f"💳 Projected cost {projected_cost:,} credits exceeds the budget of {credit_budget:,} — narrow the selection, build a plan, or raise the budget (超出点数预算)。")
+    else:
+        planned_slices = coverage_planner.plan_slices(dl_plan['plan']) if dl_plan and use_plan and not sync_to_today else None
+        job_id = worker.submit(
+            token, final_hs, final_dirs, dl_date_range[0], dl_date_range[1], dl_origins, dl_dests,
+            keyword=api_keyword_str, max_in_flight=max_in_flight, use_journal=use_journal, sync_to_today=sync_to_today,
+            planned_slices=planned_slices, keywords=api_keywords, credit_budget=credit_budget,
+            label=f"{selected_category} | " + (f"sync {dl_date_range[0]} → today" if sync_to_today else f"{dl_date_range[0]} ~ {dl_date_range[1]}")
+                  + (" | planned" if planned_slices is not None else "")
+        )
+        st.session_state['dl_active_job'] = job_id
+        st.toast(f"Job #{job_id} submitted (已提交后台任务)", icon="🚀")
+
+# --- 4. 后台任务监控 (轮询，不阻塞页面) ---
+st.markdown("#### 4️⃣ Download Jobs (后台任务)")
+
+@st.fragment(run_every=config.INGEST_POLL_SECONDS)
+def render_jobs():
+    jobs = worker.list_jobs()
+    if not jobs:
+        st.caption("No jobs yet (暂无任务)。")
+        return
+
+    overview = [{
+        "Job": f"#{j['id']}", "Label": j['label'], "State": j['state'],
+        "Tasks": f"{j['slices_done']}/{j['slices_total']}",
+        "Saved": j['stats']['saved'] if j['stats'] else sum(t['Saved'] for t in j['tasks']),
+    } for j in jobs]
+    st.dataframe(pd.DataFrame(overview), use_container_width=True, hide_index=True)
+
+    job_ids = [j['id'] for j in jobs]
+    default_id = st.session_state.get('dl_active_job', job_ids[0])
+    selected_id = st.selectbox(
+        "Job Detail (任务详情)", job_ids, index=job_ids.index(default_id) if default_id in job_ids else 0,
+        format_func=lambda jid: next(f"#{j['id']} - {j['label']} ({j['state']})" for j in jobs if j['id'] == jid)
+    )
+    job = worker.status(selected_id)
+    if not job: return
+
+    c_js1, c_js2 = st.columns([4, 1])
+    with c_js1:
+        st.progress(int(job['slices_done'] / job['slices_total'] * 100) if job['slices_total'] else 100)
+    with c_js2:
+        if job['state'] in (ingest_worker.JOB_QUEUED, ingest_worker.JOB_RUNNING):
+            if st.button("⛔ Cancel (取消)", key=f"cancel_job_{job['id']}"):
+                worker.cancel(job['id'])
+                st.rerun(scope="fragment")
+
+    st.dataframe(pd.DataFrame(job['tasks']), use_container_width=True, hide_index=True)
+    cost = job['cost']
+    if cost['balance_before'] is not None or cost['estimated']:
+        c_cost1, c_cost2, c_cost3, c_cost4 = st.columns(4)
+        c_cost1.metric("Balance Before (任务前余额)", f"{cost['balance_before']:,.0f}" if cost['balance_before'] is not None else "-")
+        c_cost2.metric("Balance After (任务后余额)", f"{cost['balance_after']:,.0f}" if cost['balance_after'] is not None else "-")
+        c_cost3.metric("Credits Spent (实际消耗)", "shared" if cost['shared_with'] else f"{cost['spent']:,.0f}" if cost['spent'] is not None else "-",
+                       delta=f"est. {cost['estimated']:,.0f}", delta_color="off",
+                       help=f"Overlapped with jobs {', '.join(cost['shared_with'])}: the balance change includes their usage (与其他任务同时运行，余额差无法单独计量)。" if cost['shared_with'] else None)
+        c_cost4.metric("Credits / Record (每条点数)", f"{cost['spent'] / cost['records']:.2f}" if cost['spent'] is not None and cost['records'] else "-")
+        if cost['estimated']:
+            with st.expander("💳 Cost Breakdown (点数明细)"):
+                st.dataframe(pd.DataFrame(journal.job_cost_breakdown(job['job_ref'])), use_container_width=True, hide_index=True)
+    if job['metrics']:
+        st.caption("⚙️ Pipeline Stages (流水线吞吐 / 队列深度)")
+        st.dataframe(pd.DataFrame(job['metrics']), use_container_width=True, hide_index=True)
+    with st.expander("Process Log (运行日志)", expanded=job['state'] == ingest_worker.JOB_RUNNING):
+        for level, msg in job['log'][-100:]:
+            getattr(st, level)(msg)
+
+    if job['state'] == ingest_worker.JOB_DONE:
+        st.success(f"🎉 Job #{job['id']} All Done (全部完成): {job['stats']['saved']} records saved")
+    elif job['state'] == ingest_worker.JOB_CANCELLED:
+        st.warning(f"⛔ Job #{job['id']} cancelled (已取消)。已完成的页已记入任务日志，可续传。")
+    elif job['state'] == ingest_worker.JOB_OVER_BUDGET:
+        st.error(f"💳 Job #{job['id']} not started: projected {job['cost']['projected']:,.0f} credits > budget {job['cost']['budget']:,.0f} (超出点数预算)")
+    elif job['state'] == ingest_worker.JOB_FAILED:
+        st.error(f"❌ Job #{job['id']} failed: {job['error']}")
+
+render_jobs()
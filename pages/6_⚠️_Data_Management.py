@@ -8,6 +8,7 @@ import utils
 st.set_page_config(page_title="Data Management", page_icon="🗑️", layout="wide")
 
 st.title("🗑️ Data Management - 数据管理工具")
+utils.render_schema_notice()
 st.markdown("""
 <div style="background-color:#ffe6e6; padding:15px; border-radius:10px; border:1px solid #ff4d4d; margin-bottom: 20px;">
     <h4 style="color:#cc0000; margin:0;">⚠️ 警告：高风险区域 (DANGER ZONE)</h4>
@@ -61,21 +62,13 @@ if 'delete_preview_count' not in st.session_state:
 if 'delete_ready' not in st.session_state:
     st.session_state['delete_ready'] = False
 
-# 构建查询条件的辅助函数
-def build_query(base_query):
-    # 时间必须有
-    if start_d and end_d:
-        base_query = base_query.gte('transaction_date', start_d).lte('transaction_date', end_d)
-    
-    # 可选条件
-    if del_origins:
-        base_query = base_query.in_('origin_country_code', del_origins)
-    if del_dests:
-        base_query = base_query.in_('dest_country_code', del_dests)
-    if del_hs_codes:
-        base_query = base_query.in_('hs_code', del_hs_codes)
-    
-    return base_query
+# 构建查询条件的辅助函数 (存储后端通用的筛选参数)
+def build_filters():
+    # 时间必须有；其余为可选条件，留空表示不限制
+    return {
+        "start_date": start_d, "end_date": end_d,
+        "origin_codes": del_origins, "dest_codes": del_dests, "hs_codes": del_hs_codes,
+    }
 
 # 扫描按钮
 col_scan, col_info = st.columns([1, 3])
@@ -86,12 +79,8 @@ with col_scan:
         else:
             with st.spinner("正在扫描数据库..."):
                 try:
-                    # 使用 count='exact', head=True 只获取数量不获取内容，速度快
-                    query = utils.supabase.table('trade_records').select("*", count='exact', head=True)
-                    query = build_query(query)
-                    response = query.execute()
-                    
-                    count = response.count
+                    # 只获取数量不获取内容，速度快
+                    count = utils.get_trade_store().count(**build_filters())
                     st.session_state['delete_preview_count'] = count
                     st.session_state['delete_ready'] = True
                     
@@ -144,22 +133,11 @@ if st.session_state.get('delete_ready') and st.session_state['delete_preview_cou
             else:
                 try:
                     with st.spinner("🗑️ 正在执行物理删除..."):
-                        # 构建删除查询
-                        query = utils.supabase.table('trade_records').delete()
-                        query = build_query(query)
-                        
                         # 执行删除
-                        # 注意：Supabase delete 操作返回的是被删除的数据列表
-                        response = query.execute()
-                        
-                        deleted_data = response.data
-                        deleted_count = len(deleted_data) if deleted_data else 0
-                        
-                        # 实际上 Supabase 有时对于大量删除不会返回所有 data，但操作是成功的
-                        # 如果是大量删除，可能需要依赖之前的 count
+                        deleted_count = utils.get_trade_store().delete(**build_filters())
                         
                         st.success(f"✅ 删除成功！")
-                        st.markdown(f"**操作反馈:** 数据库响应已清理相关记录。")
+                        st.markdown(f"**操作反馈:** 已删除 {deleted_count} 条记录。")
                         
                         # 重置状态
                         st.session_state['delete_ready'] = False
@@ -168,4 +146,40 @@ if st.session_state.get('delete_ready') and st.session_state['delete_preview_cou
                 except Exception as e:
                     st.error(f"❌ 删除失败: {e}")
 else:
-    st.caption("请先完成步骤 2 (扫描数据) 以解锁删除功能。")
\ No newline at end of file
+    st.caption("请先完成步骤 2 (扫描数据) 以解锁删除功能。")
+
+st.divider()
+
+# --- 4. 派生列回填 ---
+st.subheader("4️⃣ 派生列回填 (Backfill Derived Columns)")
+st.caption("为旧记录补算树种、产品分类、标准港口和国家名 (需先执行 sql/004_enrichment_columns.sql)。可重复执行，只处理尚未回填的行。")
+
+if st.button("🧩 开始回填 (Backfill)", disabled=not utils.enrichment_enabled()):
+    progress_bar = st.progress(0.0)
+    progress_text = st.empty()
+
+    def on_backfill_progress(done, total):
+        progress_bar.progress(min(done / total, 1.0) if total else 1.0)
+        progress_text.caption(f"已回填 {done} / {total} 条")
+
+    try:
+        with st.spinner("🧩 正在回填派生列..."):
+            filled = utils.backfill_enrichment(on_progress=on_backfill_progress)
+        progress_bar.progress(1.0)
+        st.success(f"✅ 回填完成：{filled} 条记录")
+    except Exception as e:
+        st.error(f"❌ 回填失败: {e}")
+
+st.divider()
+
+# --- 5. 覆盖日历 ---
+st.subheader("5️⃣ 覆盖日历 (Coverage Calendar)")
+st.caption("库存热力图与下载计划读取的按天记录数由数据库触发器在写入 / 删除时自动维护；仅在数据异常或手工改库后需要重建。")
+
+if st.button("🔄 重建覆盖日历 (Rebuild)", disabled=not utils.coverage_calendar_enabled()):
+    try:
+        with st.spinner("🔄 正在按 trade_records 重建覆盖日历..."):
+            utils.get_trade_store().rebuild_calendar()
+        st.success("✅ 覆盖日历已重建")
+    except Exception as e:
+        st.error(f"❌ 重建失败: {e}")
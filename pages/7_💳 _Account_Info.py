@@ -1,5 +1,6 @@
 import streamlit as st
 import utils
+import job_journal
 import pandas as pd
 from datetime import datetime
 
@@ -17,8 +18,7 @@ with col_info:
     st.info("💡 提示：数据直接来自 Tendata `/v2/account` 接口。")
 with col_btn:
     if st.button("🔄 刷新数据 (Refresh)", type="primary", use_container_width=True):
-        # 清除缓存
-        if 'token_expiry' in st.session_state: del st.session_state['token_expiry']
+        # 清除缓存 (Token 由进程级 TokenManager 统一管理，到期前自动刷新)
         if 'account_data_cache' in st.session_state: del st.session_state['account_data_cache']
         st.rerun()
 
@@ -103,7 +103,21 @@ if token:
 
     st.divider()
 
-    # --- 5. 底部折叠信息 (保持页面整洁) ---
+    # --- 5. 下载任务点数账本 (任务前后余额快照) ---
+    job_costs = job_journal.get_job_journal().recent_job_costs()
+    if job_costs:
+        st.markdown("### 💳 下载任务消耗 (Job Costs)")
+        st.dataframe(pd.DataFrame([{
+            "Job": c['job_ref'], "Label": c['label'], "State": c['state'],
+            "Started": datetime.fromtimestamp(c['started_at']).strftime("%Y-%m-%d %H:%M") if c['started_at'] else "-",
+            "Spent": c['spent'], "Estimated": c['estimated_credits'], "Records": c['records'],
+            "Credits / Record": round(c['spent'] / c['records'], 2) if c['spent'] is not None and c['records'] else None,
+            "Shared With": c['shared_with'],
+        } for c in job_costs]), use_container_width=True, hide_index=True)
+        st.caption("Spent 为任务前后余额差；与其他任务同时运行 (Shared With 非空) 时余额差无法单独归属，Spent 留空，请参考 Estimated。")
+        st.divider()
+
+    # --- 6. 底部折叠信息 (保持页面整洁) ---
     with st.expander("🔍 查看技术详情 (Debug Info)"):
         st.caption("原始 API 响应数据：")
         st.json(account_data) # 把 JSON 藏在这里，需要时再看
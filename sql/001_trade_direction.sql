@@ -0,0 +1,9 @@
+-- 001_trade_direction.sql
+-- 记录每条数据下载时使用的 Tendata catalog (imports / exports)。
+-- 覆盖率规划 (coverage_planner.py) 按方向对比本地与 API 的记录数，需要该列。
+-- 在 Supabase SQL Editor 中执行一次即可；旧数据该列为 NULL，规划时视为缺失 (会重新下载，不会漏数)。
+
+ALTER TABLE trade_records ADD COLUMN IF NOT EXISTS trade_direction text;
+
+CREATE INDEX IF NOT EXISTS idx_trade_records_direction_date_hs
+    ON trade_records (trade_direction, transaction_date, hs_code);
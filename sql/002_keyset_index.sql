@@ -0,0 +1,7 @@
+-- 002_keyset_index.sql
+-- 批量读取改为 keyset 分页 (按 transaction_date, unique_record_id 排序并从上一页末尾继续)，
+-- 需要该复合索引才能让每一页都是索引范围扫描。
+-- 在 Supabase SQL Editor 中执行一次即可。
+
+CREATE INDEX IF NOT EXISTS idx_trade_records_date_id
+    ON trade_records (transaction_date, unique_record_id);
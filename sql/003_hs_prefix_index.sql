@@ -0,0 +1,7 @@
+-- 003_hs_prefix_index.sql
+-- 首页报告与覆盖率检查改为在数据库端按 HS 前缀过滤 (hs_code LIKE '4403%' OR ...)。
+-- text_pattern_ops 让前缀 LIKE 在任意排序规则下都能走索引；带上 transaction_date 便于同时按日期范围收窄。
+-- 在 Supabase SQL Editor 中执行一次即可。
+
+CREATE INDEX IF NOT EXISTS idx_trade_records_hs_prefix_date
+    ON trade_records (hs_code text_pattern_ops, transaction_date);
@@ -0,0 +1,23 @@
+-- 004_enrichment_columns.sql
+-- 写库时计算的派生列 (utils.enrich_row)：树种、产品分类、清洗后的港口、国家英文名。
+-- 页面直接读取这些列，不再逐行重算；树种 / 产品分类可在数据库端筛选。
+-- 执行后在 Data Management 页面运行 "Backfill" 为旧记录补齐派生列 (species 为空的行)。
+-- 在 Supabase SQL Editor 中执行一次即可。
+
+ALTER TABLE trade_records
+    ADD COLUMN IF NOT EXISTS species text,
+    ADD COLUMN IF NOT EXISTS product_category text,
+    ADD COLUMN IF NOT EXISTS port_of_departure_clean text,
+    ADD COLUMN IF NOT EXISTS port_of_arrival_clean text,
+    ADD COLUMN IF NOT EXISTS origin_name text,
+    ADD COLUMN IF NOT EXISTS dest_name text;
+
+CREATE INDEX IF NOT EXISTS idx_trade_records_species_date
+    ON trade_records (species, transaction_date);
+
+CREATE INDEX IF NOT EXISTS idx_trade_records_category_date
+    ON trade_records (product_category, transaction_date);
+
+-- 回填时按 keyset 顺序查找 species 为空的旧记录
+CREATE INDEX IF NOT EXISTS idx_trade_records_unenriched
+    ON trade_records (transaction_date, unique_record_id) WHERE species IS NULL;
@@ -0,0 +1,10 @@
+-- 005_species_country_index.sql
+-- 库存检查 (Local Stock Check) 在数据库端按 species 列筛选树种，不再拉取 product_desc_text。
+-- 选定国家 + 树种时 (例如印度的 Radiata) 用该复合索引直接定位，避免 57014 语句超时。
+-- 依赖 004_enrichment_columns.sql；在 Supabase SQL Editor 中执行一次即可。
+
+CREATE INDEX IF NOT EXISTS idx_trade_records_origin_species_date
+    ON trade_records (origin_country_code, species, transaction_date);
+
+CREATE INDEX IF NOT EXISTS idx_trade_records_dest_species_date
+    ON trade_records (dest_country_code, species, transaction_date);
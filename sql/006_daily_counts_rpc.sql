@@ -0,0 +1,36 @@
+-- 006_daily_counts_rpc.sql
+-- 库存检查 (Local Stock Check) 的服务端聚合：按筛选条件返回每天、每个 HS 的记录数，
+-- 替代原来拉取最多 10 万行明细再在本地 value_counts() 的做法 (繁忙时段会被截断)。
+-- 由 SupabaseTradeStore.daily_counts 通过 RPC 调用；参数为空 (NULL) 表示不限制。
+-- 依赖 004_enrichment_columns.sql (species / product_category 列)；在 Supabase SQL Editor 中执行一次即可。
+
+CREATE OR REPLACE FUNCTION trade_daily_counts(
+    p_start_date date DEFAULT NULL,
+    p_end_date date DEFAULT NULL,
+    p_hs_prefixes text[] DEFAULT NULL,
+    p_hs_codes text[] DEFAULT NULL,
+    p_trade_direction text DEFAULT NULL,
+    p_origin_codes text[] DEFAULT NULL,
+    p_dest_codes text[] DEFAULT NULL,
+    p_keyword text DEFAULT NULL,
+    p_species text[] DEFAULT NULL,
+    p_product_categories text[] DEFAULT NULL
+)
+RETURNS TABLE (transaction_date date, hs_code text, count bigint)
+LANGUAGE sql STABLE
+AS $$
+    SELECT t.transaction_date::date, t.hs_code::text, COUNT(*)
+    FROM trade_records t
+    WHERE (p_start_date IS NULL OR t.transaction_date >= p_start_date)
+      AND (p_end_date IS NULL OR t.transaction_date <= p_end_date)
+      AND (p_hs_prefixes IS NULL OR t.hs_code LIKE ANY (SELECT p || '%' FROM unnest(p_hs_prefixes) AS p))
+      AND (p_hs_codes IS NULL OR t.hs_code = ANY (p_hs_codes))
+      AND (p_trade_direction IS NULL OR t.trade_direction = p_trade_direction)
+      AND (p_origin_codes IS NULL OR t.origin_country_code = ANY (p_origin_codes))
+      AND (p_dest_codes IS NULL OR t.dest_country_code = ANY (p_dest_codes))
+      AND (p_keyword IS NULL OR t.product_desc_text ILIKE '%' || p_keyword || '%')
+      AND (p_species IS NULL OR t.species = ANY (p_species))
+      AND (p_product_categories IS NULL OR t.product_category = ANY (p_product_categories))
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
+$$;
@@ -0,0 +1,110 @@
+-- 007_coverage_calendar.sql
+-- 覆盖日历：按 (日期, HS, 方向, 出口国, 进口国) 记录 trade_records 的条数，由语句级触发器在写入时增量维护。
+-- 下载引擎的 upsert (INSERT ... ON CONFLICT DO UPDATE)、Data Management 的删除都会同步更新，
+-- 库存热力图与下载计划读取这张小表即可，不需要扫描 trade_records。
+-- 键列中的 NULL 统一记为 '' (主键不允许 NULL)。
+-- 在 Supabase SQL Editor 中执行一次即可 (执行时会按现有数据初始化)；数据异常时可调用 rebuild_trade_coverage_calendar() 重建。
+
+CREATE TABLE IF NOT EXISTS trade_coverage_calendar (
+    transaction_date date NOT NULL,
+    hs_code text NOT NULL DEFAULT '',
+    trade_direction text NOT NULL DEFAULT '',
+    origin_country_code text NOT NULL DEFAULT '',
+    dest_country_code text NOT NULL DEFAULT '',
+    record_count bigint NOT NULL,
+    PRIMARY KEY (transaction_date, hs_code, trade_direction, origin_country_code, dest_country_code)
+);
+
+-- 清理计数归零的行时使用
+CREATE INDEX IF NOT EXISTS idx_trade_coverage_calendar_empty
+    ON trade_coverage_calendar (transaction_date) WHERE record_count <= 0;
+
+CREATE OR REPLACE FUNCTION trade_coverage_calendar_sync()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        WITH removed AS (
+            SELECT transaction_date::date AS d, COALESCE(hs_code, '') AS hs, COALESCE(trade_direction, '') AS dir,
+                   COALESCE(origin_country_code, '') AS o, COALESCE(dest_country_code, '') AS de, COUNT(*) AS n
+            FROM old_rows GROUP BY 1, 2, 3, 4, 5
+        )
+        UPDATE trade_coverage_calendar c SET record_count = c.record_count - r.n
+        FROM removed r
+        WHERE c.transaction_date = r.d AND c.hs_code = r.hs AND c.trade_direction = r.dir
+          AND c.origin_country_code = r.o AND c.dest_country_code = r.de;
+        DELETE FROM trade_coverage_calendar WHERE record_count <= 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        -- 按主键顺序写入，减少并发 upsert 之间的死锁
+        INSERT INTO trade_coverage_calendar AS c
+            (transaction_date, hs_code, trade_direction, origin_country_code, dest_country_code, record_count)
+        SELECT transaction_date::date, COALESCE(hs_code, ''), COALESCE(trade_direction, ''),
+               COALESCE(origin_country_code, ''), COALESCE(dest_country_code, ''), COUNT(*)
+        FROM new_rows GROUP BY 1, 2, 3, 4, 5 ORDER BY 1, 2, 3, 4, 5
+        ON CONFLICT (transaction_date, hs_code, trade_direction, origin_country_code, dest_country_code)
+        DO UPDATE SET record_count = c.record_count + EXCLUDED.record_count;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trade_coverage_calendar_ins ON trade_records;
+CREATE TRIGGER trade_coverage_calendar_ins
+    AFTER INSERT ON trade_records
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trade_coverage_calendar_sync();
+
+DROP TRIGGER IF EXISTS trade_coverage_calendar_upd ON trade_records;
+CREATE TRIGGER trade_coverage_calendar_upd
+    AFTER UPDATE ON trade_records
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trade_coverage_calendar_sync();
+
+DROP TRIGGER IF EXISTS trade_coverage_calendar_del ON trade_records;
+CREATE TRIGGER trade_coverage_calendar_del
+    AFTER DELETE ON trade_records
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trade_coverage_calendar_sync();
+
+-- 全量重建 (初始化 / 修复)
+CREATE OR REPLACE FUNCTION rebuild_trade_coverage_calendar()
+RETURNS void
+LANGUAGE sql
+AS $$
+    DELETE FROM trade_coverage_calendar;
+    INSERT INTO trade_coverage_calendar
+        (transaction_date, hs_code, trade_direction, origin_country_code, dest_country_code, record_count)
+    SELECT transaction_date::date, COALESCE(hs_code, ''), COALESCE(trade_direction, ''),
+           COALESCE(origin_country_code, ''), COALESCE(dest_country_code, ''), COUNT(*)
+    FROM trade_records GROUP BY 1, 2, 3, 4, 5;
+$$;
+
+SELECT rebuild_trade_coverage_calendar();
+
+-- 按天、按 HS 汇总日历 (参数与 006 的 trade_daily_counts 一致，只支持日历的键列)
+CREATE OR REPLACE FUNCTION coverage_daily_counts(
+    p_start_date date DEFAULT NULL,
+    p_end_date date DEFAULT NULL,
+    p_hs_prefixes text[] DEFAULT NULL,
+    p_hs_codes text[] DEFAULT NULL,
+    p_trade_direction text DEFAULT NULL,
+    p_origin_codes text[] DEFAULT NULL,
+    p_dest_codes text[] DEFAULT NULL
+)
+RETURNS TABLE (transaction_date date, hs_code text, count bigint)
+LANGUAGE sql STABLE
+AS $$
+    SELECT c.transaction_date, c.hs_code, SUM(c.record_count)::bigint
+    FROM trade_coverage_calendar c
+    WHERE (p_start_date IS NULL OR c.transaction_date >= p_start_date)
+      AND (p_end_date IS NULL OR c.transaction_date <= p_end_date)
+      AND (p_hs_prefixes IS NULL OR c.hs_code LIKE ANY (SELECT p || '%' FROM unnest(p_hs_prefixes) AS p))
+      AND (p_hs_codes IS NULL OR c.hs_code = ANY (p_hs_codes))
+      AND (p_trade_direction IS NULL OR c.trade_direction = p_trade_direction)
+      AND (p_origin_codes IS NULL OR c.origin_country_code = ANY (p_origin_codes))
+      AND (p_dest_codes IS NULL OR c.dest_country_code = ANY (p_dest_codes))
+    GROUP BY 1, 2
+    ORDER BY 1, 2;
+$$;
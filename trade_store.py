@@ -0,0 +1,433 @@
+# trade_store.py
+# trade_records 存储接口：页面和下载引擎只通过 TradeStore 读写贸易记录，
+# 后端可以是托管的 Supabase (默认)，也可以是本地嵌入式 SQLite 文件 (离线 / 压测 / 内网环境)。
+# 两个实现的筛选、分页、upsert、计数和删除语义保持一致：
+#   start_date / end_date  —— transaction_date 闭区间
+#   hs_prefixes            —— HS 前缀匹配 (任一前缀即可)
+#   hs_codes               —— HS 精确匹配
+#   trade_direction        —— imports / exports
+#   origin_codes / dest_codes —— 国家代码 IN 列表
+#   keyword                —— product_desc_text 包含关键词 (不区分大小写)
+#   species / product_categories —— 入库时计算的树种 / 产品分类 IN 列表 (见 utils.enrich_row)
+#   unenriched             —— 只匹配尚未计算派生列的旧记录 (species 为空，回填用)
+# 按天计数 (daily_counts) 在数据库端聚合，只返回 (transaction_date, hs_code, count) 行。
+# 覆盖日历 (calendar_counts) 读取写入时由触发器维护的 trade_coverage_calendar 小表，
+# 按 (日期, HS, 方向, 出口国, 进口国) 记录条数；upsert 与删除都会同步，不需要扫描 trade_records。
+# 批量读取使用 keyset 分页 (iter_pages)：按 (transaction_date, unique_record_id) 排序，
+# 每页从上一页最后一行之后开始，走索引范围扫描，且不受并发 upsert 影响 (不会跳行 / 重复)。
+
+import json
+import sqlite3
+import threading
+
+FILTER_KEYS = ("start_date", "end_date", "hs_prefixes", "hs_codes", "trade_direction", "origin_codes", "dest_codes", "keyword",
+               "species", "product_categories", "unenriched")
+
+# 本地库的列定义 (与 Supabase 上的 trade_records 对应)；upsert 遇到新列时自动 ALTER TABLE 补齐
+LOCAL_COLUMNS = {
+    "unique_record_id": "TEXT PRIMARY KEY",
+    "transaction_date": "TEXT",
+    "hs_code": "TEXT",
+    "product_desc_text": "TEXT",
+    "origin_country_code": "TEXT",
+    "dest_country_code": "TEXT",
+    "port_of_departure": "TEXT",
+    "port_of_arrival": "TEXT",
+    "importer_name": "TEXT",
+    "exporter_name": "TEXT",
+    "quantity": "REAL",
+    "quantity_unit": "TEXT",
+    "total_value_usd": "REAL",
+    "trade_direction": "TEXT",
+    "species": "TEXT",
+    "product_category": "TEXT",
+    "port_of_departure_clean": "TEXT",
+    "port_of_arrival_clean": "TEXT",
+    "origin_name": "TEXT",
+    "dest_name": "TEXT",
+    "raw_data": "TEXT",
+}
+JSON_COLUMNS = ("raw_data",)
+KEYSET_COLUMNS = ("transaction_date", "unique_record_id")
+ENRICHMENT_COLUMNS = ("species", "product_category", "port_of_departure_clean", "port_of_arrival_clean", "origin_name", "dest_name")
+# 依赖数据库迁移的功能 -> 对应的迁移文件 (本地 SQLite 自动建表，始终可用)
+SCHEMA_FEATURES = {
+    "trade_direction": "sql/001_trade_direction.sql",
+    "enrichment": "sql/004_enrichment_columns.sql",
+    "daily_counts": "sql/006_daily_counts_rpc.sql",
+    "coverage_calendar": "sql/007_coverage_calendar.sql",
+}
+# PostgREST / Postgres 报告列、表或函数不存在时的错误码与提示
+MISSING_OBJECT_MARKERS = ("42703", "42P01", "42883", "PGRST202", "PGRST204", "PGRST205", "does not exist", "Could not find")
+CALENDAR_KEY_COLUMNS = ("transaction_date", "hs_code", "trade_direction", "origin_country_code", "dest_country_code")
+CALENDAR_FILTER_KEYS = ("start_date", "end_date", "hs_prefixes", "hs_codes", "trade_direction", "origin_codes", "dest_codes")
+
+
+def parse_columns(columns):
+    """'a, b,c' / '*' -> ['a', 'b', 'c'] / None"""
+    if not columns or columns.strip() == "*": return None
+    return [c.strip() for c in columns.split(",") if c.strip()]
+
+
+def check_calendar_filters(filters):
+    """覆盖日历只有键列，不能按关键词 / 树种 / 产品分类筛选。"""
+    unsupported = [key for key, value in filters.items() if value and key not in CALENDAR_FILTER_KEYS]
+    if unsupported: raise ValueError(f"coverage calendar does not support filters: {', '.join(unsupported)}")
+
+
+def keyset_columns(columns):
+    """keyset 分页需要读到排序键，列清单中缺少时补上。"""
+    names = parse_columns(columns)
+    if names is None: return "*"
+    return ",".join(names + [c for c in KEYSET_COLUMNS if c not in names])
+
+
+class TradeStore:
+    """trade_records 存储接口。filters 为上方 FILTER_KEYS 中的关键字参数，值为空表示不限制。"""
+
+    def upsert(self, rows, returning_minimal=False):
+        """按 unique_record_id 批量 upsert；失败时抛出异常。"""
+        raise NotImplementedError
+
+    def count(self, **filters):
+        raise NotImplementedError
+
+    def select(self, columns="*", order_by=None, desc=False, offset=0, limit=None, **filters):
+        """返回 list[dict]；offset / limit 与 Supabase 的 .range(offset, offset + limit - 1) 等价。"""
+        raise NotImplementedError
+
+    def delete(self, **filters):
+        """删除匹配的记录，返回删除条数。"""
+        raise NotImplementedError
+
+    def select_page(self, columns="*", after=None, limit=1000, **filters):
+        """
+        keyset 分页的一页：按 (transaction_date, unique_record_id) 升序，
+        只返回排在 after = (transaction_date, unique_record_id) 之后的行。
+        """
+        raise NotImplementedError
+
+    def daily_counts(self, **filters):
+        """按 (transaction_date, hs_code) 聚合的精确记录数，返回 [{'transaction_date', 'hs_code', 'count'}, ...]。"""
+        raise NotImplementedError
+
+    def calendar_counts(self, **filters):
+        """与 daily_counts 相同的结果，但读取覆盖日历；filters 仅限 CALENDAR_FILTER_KEYS。"""
+        raise NotImplementedError
+
+    def rebuild_calendar(self):
+        """按 trade_records 全量重建覆盖日历 (初始化或修复用)。"""
+        raise NotImplementedError
+
+    def schema_features(self):
+        """探测 SCHEMA_FEATURES 中各项迁移是否已执行，返回 {feature: bool}；连接失败等其他错误直接抛出。"""
+        return {name: True for name in SCHEMA_FEATURES}
+
+    def iter_pages(self, columns="*", page_size=1000, **filters):
+        """逐页返回所有匹配的行 (keyset 分页)。"""
+        after = None
+        while True:
+            rows = self.select_page(columns, after=after, limit=page_size, **filters)
+            if rows: yield rows
+            if len(rows) < page_size: return
+            after = (rows[-1]['transaction_date'], rows[-1]['unique_record_id'])
+
+
+class SupabaseTradeStore(TradeStore):
+    """托管 Supabase (PostgREST) 实现。"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _table(self):
+        if not self.client: raise RuntimeError("Supabase client not initialised")
+        return self.client.table('trade_records')
+
+    @staticmethod
+    def _apply(query, start_date=None, end_date=None, hs_prefixes=None, hs_codes=None, trade_direction=None,
+               origin_codes=None, dest_codes=None, keyword=None, species=None, product_categories=None, unenriched=False):
+        if start_date: query = query.gte('transaction_date', str(start_date))
+        if end_date: query = query.lte('transaction_date', str(end_date))
+        if hs_prefixes:
+            if len(hs_prefixes) == 1: query = query.like('hs_code', f"{hs_prefixes[0]}%")
+            else: query = query.or_(",".join(f"hs_code.like.{p}%" for p in hs_prefixes))
+        if hs_codes: query = query.in_('hs_code', list(hs_codes))
+        if trade_direction: query = query.eq('trade_direction', trade_direction)
+        if origin_codes: query = query.in_('origin_country_code', list(origin_codes))
+        if dest_codes: query = query.in_('dest_country_code', list(dest_codes))
+        if keyword: query = query.ilike('product_desc_text', f"%{keyword}%")
+        if species: query = query.in_('species', list(species))
+        if product_categories: query = query.in_('product_category', list(product_categories))
+        if unenriched: query = query.is_('species', 'null')
+        return query
+
+    def upsert(self, rows, returning_minimal=False):
+        if not rows: return
+        if returning_minimal:
+            self._table().upsert(rows, on_conflict='unique_record_id', returning="minimal").execute()
+        else:
+            self._table().upsert(rows, on_conflict='unique_record_id').execute()
+
+    def count(self, **filters):
+        query = self._apply(self._table().select("unique_record_id", count='exact', head=True), **filters)
+        return query.execute().count or 0
+
+    def select(self, columns="*", order_by=None, desc=False, offset=0, limit=None, **filters):
+        query = self._apply(self._table().select(columns), **filters)
+        if order_by: query = query.order(order_by, desc=desc)
+        if limit is not None: query = query.range(offset, offset + limit - 1)
+        return query.execute().data or []
+
+    def select_page(self, columns="*", after=None, limit=1000, **filters):
+        columns = keyset_columns(columns)
+        rows = []
+        if after:
+            # (date, id) > (d, i) 拆成两个不含 OR 的范围查询：先取同一天中 id 更大的行，不够再取之后的日期
+            rows = self._apply(self._table().select(columns), **filters)\
+                .eq('transaction_date', str(after[0])).gt('unique_record_id', after[1])\
+                .order('unique_record_id').limit(limit).execute().data or []
+            if len(rows) >= limit: return rows
+        query = self._apply(self._table().select(columns), **filters)
+        if after: query = query.gt('transaction_date', str(after[0]))
+        rows += query.order('transaction_date').order('unique_record_id').limit(limit - len(rows)).execute().data or []
+        return rows
+
+    def schema_features(self):
+        if not self.client: raise RuntimeError("Supabase client not initialised")
+
+        def available(probe):
+            try:
+                probe()
+                return True
+            except Exception as e:
+                if any(marker in str(e) for marker in MISSING_OBJECT_MARKERS): return False
+                raise
+
+        no_rows = {"p_start_date": "1900-01-01", "p_end_date": "1900-01-01"}
+        return {
+            "trade_direction": available(lambda: self._table().select("trade_direction").limit(1).execute()),
+            "enrichment": available(lambda: self._table().select(",".join(ENRICHMENT_COLUMNS)).limit(1).execute()),
+            "daily_counts": available(lambda: self.client.rpc('trade_daily_counts', no_rows).execute()),
+            "coverage_calendar": available(lambda: self.client.rpc('coverage_daily_counts', no_rows).execute()),
+        }
+
+    def _rpc_counts(self, function, filters):
+        """调用按 (date, hs_code) 排序返回计数的 RPC；分段读取以避开 PostgREST 的单次行数上限。"""
+        if not self.client: raise RuntimeError("Supabase client not initialised")
+        params = {}
+        for key, value in filters.items():
+            if not value: continue
+            params[f"p_{key}"] = list(value) if isinstance(value, (list, tuple, set)) else str(value)
+        rows, page = [], 1000
+        while True:
+            data = self.client.rpc(function, params).range(len(rows), len(rows) + page - 1).execute().data or []
+            rows.extend(data)
+            if len(data) < page: return rows
+
+    def daily_counts(self, **filters):
+        # sql/006_daily_counts_rpc.sql
+        if filters.get('unenriched'): raise ValueError("daily_counts does not support the unenriched filter")
+        return self._rpc_counts('trade_daily_counts', filters)
+
+    def calendar_counts(self, **filters):
+        # sql/007_coverage_calendar.sql
+        check_calendar_filters(filters)
+        return self._rpc_counts('coverage_daily_counts', filters)
+
+    def rebuild_calendar(self):
+        if not self.client: raise RuntimeError("Supabase client not initialised")
+        self.client.rpc('rebuild_trade_coverage_calendar', {}).execute()
+
+    def delete(self, **filters):
+        # 由 Content-Range 给出精确删除条数，不回传被删行
+        response = self._apply(self._table().delete(count='exact', returning="minimal"), **filters).execute()
+        return response.count
+
+
+class SQLiteTradeStore(TradeStore):
+    """本地嵌入式实现 (单个 SQLite 文件，WAL 模式，单连接 + 锁，工作线程可直接写入)。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        cols = ", ".join(f"{name} {kind}" for name, kind in LOCAL_COLUMNS.items())
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS trade_records ({cols});
+            CREATE INDEX IF NOT EXISTS idx_trade_records_date_hs ON trade_records (transaction_date, hs_code);
+            CREATE INDEX IF NOT EXISTS idx_trade_records_date_id ON trade_records (transaction_date, unique_record_id);
+            CREATE INDEX IF NOT EXISTS idx_trade_records_direction_date_hs ON trade_records (trade_direction, transaction_date, hs_code);
+            CREATE INDEX IF NOT EXISTS idx_trade_records_origin_date ON trade_records (origin_country_code, transaction_date);
+            CREATE INDEX IF NOT EXISTS idx_trade_records_dest_date ON trade_records (dest_country_code, transaction_date);
+        """)
+        self._columns = {r[1] for r in self._conn.execute("PRAGMA table_info(trade_records)")}
+        # 旧版本创建的本地库缺少派生列时补齐，再建派生列索引
+        self._ensure_columns_locked(LOCAL_COLUMNS)
+        self._conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_trade_records_species_date ON trade_records (species, transaction_date);
+            CREATE INDEX IF NOT EXISTS idx_trade_records_category_date ON trade_records (product_category, transaction_date);
+            CREATE INDEX IF NOT EXISTS idx_trade_records_origin_species_date ON trade_records (origin_country_code, species, transaction_date);
+            CREATE INDEX IF NOT EXISTS idx_trade_records_dest_species_date ON trade_records (dest_country_code, species, transaction_date);
+        """)
+        self._create_calendar_locked()
+        self._conn.commit()
+
+    @staticmethod
+    def _where(start_date=None, end_date=None, hs_prefixes=None, hs_codes=None, trade_direction=None,
+               origin_codes=None, dest_codes=None, keyword=None, species=None, product_categories=None, unenriched=False):
+        clauses, params = [], []
+        if start_date: clauses.append("transaction_date >= ?"); params.append(str(start_date))
+        if end_date: clauses.append("transaction_date <= ?"); params.append(str(end_date))
+        if hs_prefixes:
+            clauses.append("(" + " OR ".join("hs_code LIKE ?" for _ in hs_prefixes) + ")")
+            params.extend(f"{p}%" for p in hs_prefixes)
+        if hs_codes:
+            clauses.append(f"hs_code IN ({','.join('?' * len(hs_codes))})"); params.extend(hs_codes)
+        if trade_direction: clauses.append("trade_direction = ?"); params.append(trade_direction)
+        if origin_codes:
+            clauses.append(f"origin_country_code IN ({','.join('?' * len(origin_codes))})"); params.extend(origin_codes)
+        if dest_codes:
+            clauses.append(f"dest_country_code IN ({','.join('?' * len(dest_codes))})"); params.extend(dest_codes)
+        # SQLite 的 LIKE 对 ASCII 不区分大小写，与 Postgres ilike 一致
+        if keyword: clauses.append("product_desc_text LIKE ?"); params.append(f"%{keyword}%")
+        if species:
+            clauses.append(f"species IN ({','.join('?' * len(species))})"); params.extend(species)
+        if product_categories:
+            clauses.append(f"product_category IN ({','.join('?' * len(product_categories))})"); params.extend(product_categories)
+        if unenriched: clauses.append("species IS NULL")
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _create_calendar_locked(self):
+        """覆盖日历表 + trade_records 上的触发器 (与 sql/007_coverage_calendar.sql 对应)；新建时按现有数据初始化。"""
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trade_coverage_calendar'").fetchone()
+        keys = ", ".join(CALENDAR_KEY_COLUMNS)
+        old_key = " AND ".join(f"{c} = COALESCE(OLD.{c}, '')" for c in CALENDAR_KEY_COLUMNS)
+        add = (f"INSERT INTO trade_coverage_calendar ({keys}, record_count) VALUES ({self._calendar_key_values('NEW.')}, 1) "
+               f"ON CONFLICT({keys}) DO UPDATE SET record_count = record_count + 1;")
+        remove = (f"UPDATE trade_coverage_calendar SET record_count = record_count - 1 WHERE {old_key}; "
+                  f"DELETE FROM trade_coverage_calendar WHERE {old_key} AND record_count <= 0;")
+        changed = " OR ".join(f"NEW.{c} IS NOT OLD.{c}" for c in CALENDAR_KEY_COLUMNS)
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS trade_coverage_calendar (
+                {", ".join(f"{c} TEXT NOT NULL" for c in CALENDAR_KEY_COLUMNS)},
+                record_count INTEGER NOT NULL,
+                PRIMARY KEY ({keys})
+            );
+            CREATE TRIGGER IF NOT EXISTS trade_coverage_calendar_ins AFTER INSERT ON trade_records
+            BEGIN {add} END;
+            CREATE TRIGGER IF NOT EXISTS trade_coverage_calendar_del AFTER DELETE ON trade_records
+            BEGIN {remove} END;
+            CREATE TRIGGER IF NOT EXISTS trade_coverage_calendar_upd AFTER UPDATE OF {keys} ON trade_records
+            WHEN {changed}
+            BEGIN {remove} {add} END;
+        """)
+        if not exists: self._rebuild_calendar_locked()
+
+    @staticmethod
+    def _calendar_key_values(prefix=""):
+        # 日历键列不允许 NULL (NULL 在主键中互不相等，计数无法合并)，统一记为 ''
+        return ", ".join(f"COALESCE({prefix}{c}, '')" for c in CALENDAR_KEY_COLUMNS)
+
+    def _rebuild_calendar_locked(self):
+        values = self._calendar_key_values()
+        self._conn.execute("DELETE FROM trade_coverage_calendar")
+        self._conn.execute(
+            f"INSERT INTO trade_coverage_calendar ({', '.join(CALENDAR_KEY_COLUMNS)}, record_count) "
+            f"SELECT {values}, COUNT(*) FROM trade_records GROUP BY {values}")
+
+    def _ensure_columns_locked(self, names):
+        for name in names:
+            if name not in self._columns:
+                self._conn.execute(f"ALTER TABLE trade_records ADD COLUMN {name}")
+                self._columns.add(name)
+
+    def upsert(self, rows, returning_minimal=False):
+        if not rows: return
+        # 不同行的键可能不同 (例如是否带 raw_data)，按列集合分组写入
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(row)
+        with self._lock:
+            try:
+                for names, group in groups.items():
+                    self._ensure_columns_locked(names)
+                    updates = ", ".join(f"{n} = excluded.{n}" for n in names if n != "unique_record_id")
+                    sql = (f"INSERT INTO trade_records ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+                           f"ON CONFLICT(unique_record_id) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING"))
+                    self._conn.executemany(sql, [
+                        [json.dumps(row[n], ensure_ascii=False) if n in JSON_COLUMNS and row[n] is not None else row[n] for n in names]
+                        for row in group
+                    ])
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def count(self, **filters):
+        where, params = self._where(**filters)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM trade_records{where}", params).fetchone()[0]
+
+    def select(self, columns="*", order_by=None, desc=False, offset=0, limit=None, **filters):
+        names = parse_columns(columns)
+        where, params = self._where(**filters)
+        sql = f"SELECT {', '.join(names) if names else '*'} FROM trade_records{where}"
+        if order_by: sql += f" ORDER BY {order_by} {'DESC' if desc else 'ASC'}"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"; params = params + [limit, offset]
+        with self._lock:
+            rows = [dict(r) for r in self._conn.execute(sql, params).fetchall()]
+        for row in rows:
+            for name in JSON_COLUMNS:
+                if row.get(name): row[name] = json.loads(row[name])
+        return rows
+
+    def daily_counts(self, **filters):
+        where, params = self._where(**filters)
+        sql = (f"SELECT transaction_date, hs_code, COUNT(*) AS count FROM trade_records{where} "
+               f"GROUP BY transaction_date, hs_code ORDER BY transaction_date, hs_code")
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(sql, params).fetchall()]
+
+    def calendar_counts(self, **filters):
+        check_calendar_filters(filters)
+        where, params = self._where(**filters)
+        sql = (f"SELECT transaction_date, hs_code, SUM(record_count) AS count FROM trade_coverage_calendar{where} "
+               f"GROUP BY transaction_date, hs_code ORDER BY transaction_date, hs_code")
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(sql, params).fetchall()]
+
+    def rebuild_calendar(self):
+        with self._lock:
+            try:
+                self._rebuild_calendar_locked()
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def select_page(self, columns="*", after=None, limit=1000, **filters):
+        names = parse_columns(keyset_columns(columns))
+        where, params = self._where(**filters)
+        if after:
+            where += (" AND " if where else " WHERE ") + "(transaction_date, unique_record_id) > (?, ?)"
+            params = params + [str(after[0]), after[1]]
+        sql = (f"SELECT {', '.join(names) if names else '*'} FROM trade_records{where} "
+               f"ORDER BY transaction_date, unique_record_id LIMIT ?")
+        with self._lock:
+            rows = [dict(r) for r in self._conn.execute(sql, params + [limit]).fetchall()]
+        for row in rows:
+            for name in JSON_COLUMNS:
+                if row.get(name): row[name] = json.loads(row[name])
+        return rows
+
+    def delete(self, **filters):
+        where, params = self._where(**filters)
+        with self._lock:
+            deleted = self._conn.execute(f"DELETE FROM trade_records{where}", params).rowcount
+            self._conn.commit()
+        return deleted
@@ -1,10 +1,16 @@
 import streamlit as st
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+import gzip
+import json
+import random
+import threading
 import time
 from datetime import datetime, timedelta
 from supabase import create_client, Client
 import config  # 引用 config.py
+import trade_store
 
 # --- 核心配置 ---
 # ⚠️ 请确保这里的 URL 和 Key 是正确的 (基于你之前提供的代码)
@@ -12,8 +18,12 @@ SUPABASE_URL = "https://ajfmhcustdzdmcbgowgx.supabase.co"
 SUPABASE_KEY = "sb_secret_UdSZUH99OqFQ0Irca_LUWg_a7Sp-j_7"
 TENDATA_API_KEY = "42127b0db5597b4a0d7063b99900c0eb"
 
+def tendata_url(path):
+    """Tendata 接口地址；config.TENDATA_BASE_URL 可指向本地 mock_tendata.py 做离线压测。"""
+    return config.TENDATA_BASE_URL.rstrip('/') + path
+
 # ✅ 新增：账户信息查询接口 (用于获取余额和会员有效期)
-ACCOUNT_INFO_URL = "https://open-api.tendata.cn/v2/account"
+ACCOUNT_INFO_URL = tendata_url("/v2/account")
 
 # --- 1. 数据库连接 (使用缓存，避免重复连接) ---
 @st.cache_resource
@@ -26,52 +36,358 @@ def init_supabase():
 
 supabase = init_supabase()
 
-# --- 2. 自动 Token 管理 ---
-def get_auto_token(force_refresh=False):
+@st.cache_resource
+def get_trade_store():
     """
-    获取访问 Token (Access Token)。
-    修复说明：只负责获取 Token 和临时有效期 (7200s)，不再强制获取余额。
-    :param force_refresh: 如果为 True，将忽略缓存，强制向 API 请求新 Token
+    trade_records 的存储后端 (config.STORAGE_BACKEND)：
+    "supabase" 为托管数据库，"sqlite" 为本地文件 config.LOCAL_STORE_PATH (离线 / 压测用)。
     """
-    # 1. 缓存检查
-    if not force_refresh and 'access_token' in st.session_state and 'token_expiry' in st.session_state:
-        if time.time() < st.session_state['token_expiry']:
-            return st.session_state['access_token']
+    if config.STORAGE_BACKEND == "sqlite":
+        return trade_store.SQLiteTradeStore(config.LOCAL_STORE_PATH)
+    return trade_store.SupabaseTradeStore(supabase)
 
-    # --- 请求新 Token ---
-    auth_url = "https://open-api.tendata.cn/v2/access-token" 
-    params = { "apiKey": TENDATA_API_KEY }
-    
-    try:
-        res = requests.get(auth_url, params=params)
-        res_json = res.json()
-        
-        # 检查是否成功 (Code 200)
-        if str(res_json.get('code')) == '200':
-            data = res_json.get('data', {})
-            new_token = data.get('accessToken')
-            
-            # --- 有效期解析 ---
-            # API 返回的是 expiresIn: 7200 (秒)
-            expires_in_seconds = data.get('expiresIn', 7200)
-            
-            # 兼容性处理：如果返回的是字符串且是数字
-            if isinstance(expires_in_seconds, str) and expires_in_seconds.isdigit():
-                expires_in_seconds = int(expires_in_seconds)
-            
-            # 存入 Session
-            st.session_state['access_token'] = new_token
-            # 设置本地过期时间 (当前时间 + 有效期秒数 - 60秒缓冲)
-            st.session_state['token_expiry'] = time.time() + expires_in_seconds - 60 
-            
-            return new_token
+@st.cache_resource
+def get_schema_state():
+    """进程级缓存的迁移探测结果 (每个进程只探测一次)。"""
+    return {"lock": threading.Lock(), "features": None, "retry_at": 0.0}
+
+def schema_features():
+    """
+    返回 {feature: bool}：存储后端是否已执行 trade_store.SCHEMA_FEATURES 中对应的迁移。
+    首次调用时探测并缓存。探测本身失败 (网络 / 连接问题) 时不缓存，按已迁移处理 (与探测前的行为一致，
+    真正的读写错误照常暴露)，config.SCHEMA_PROBE_RETRY_SECONDS 后再探测，避免每页都等一次超时。
+    可在工作线程中调用 (不使用 st.*)。
+    """
+    state = get_schema_state()
+    with state["lock"]:
+        if state["features"] is None and time.time() >= state["retry_at"]:
+            try:
+                state["features"] = get_trade_store().schema_features()
+            except Exception as e:
+                print(f"Schema probe failed: {e}")
+                state["retry_at"] = time.time() + config.SCHEMA_PROBE_RETRY_SECONDS
+        return state["features"] or {name: True for name in trade_store.SCHEMA_FEATURES}
+
+def enrichment_enabled():
+    """config.ENRICH_ON_INGEST 已开启且派生列已存在 (sql/004)。"""
+    return config.ENRICH_ON_INGEST and schema_features()["enrichment"]
+
+def coverage_calendar_enabled():
+    """config.USE_COVERAGE_CALENDAR 已开启且覆盖日历已创建 (sql/007)。"""
+    return config.USE_COVERAGE_CALENDAR and schema_features()["coverage_calendar"]
+
+def missing_migrations():
+    """尚未在数据库中执行的迁移文件列表。"""
+    features = schema_features()
+    return [path for name, path in trade_store.SCHEMA_FEATURES.items() if not features[name]]
+
+def render_schema_notice():
+    """数据库缺少迁移时在页面顶部提示，并说明已降级的功能。"""
+    missing = missing_migrations()
+    if not missing: return
+    st.warning(
+        "⚠️ 数据库尚未执行以下迁移，相关功能已自动降级 (Database is missing migrations): "
+        + ", ".join(f"`{path}`" for path in missing)
+        + "。未执行 001 时不写入 / 不按贸易方向统计；004 时不写入树种等派生列；"
+        + "006 / 007 时库存统计改为拉取行计数 (较慢)。"
+    )
+
+# --- 1.5 Tendata HTTP 客户端 (进程级共享连接池 + Keep-Alive) ---
+def tendata_pool_size():
+    """
+    连接池容量：同时运行的下载任务各自最多 DOWNLOAD_MAX_IN_FLIGHT_LIMIT 个在途请求，
+    再加上规划 / 预检的计数并发。池不足时 urllib3 会丢弃多余连接，每个请求重新握手。
+    """
+    demand = (config.INGEST_MAX_CONCURRENT_JOBS * config.DOWNLOAD_MAX_IN_FLIGHT_LIMIT
+              + max(config.PLAN_MAX_WORKERS, config.API_COUNT_MAX_WORKERS))
+    return max(config.TENDATA_HTTP_POOL_SIZE, demand)
+
+@st.cache_resource
+def get_tendata_session():
+    """
+    所有 Tendata 请求共用一个 Session，复用 TCP/TLS 连接，避免每页都重新握手。
+    使用 cache_resource 保证跨会话、跨页面 (以及 importlib.reload) 只创建一次。
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=tendata_pool_size(), max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate" if config.TENDATA_GZIP_RESPONSE else "identity",
+    })
+    return session
+
+class CircuitOpenError(Exception):
+    """熔断器打开期间等待超时。"""
+
+class CircuitBreaker:
+    """
+    进程级熔断器：连续失败达到阈值后打开，所有工作线程在 before_request() 处暂停，
+    冷却期结束后只放行一个探测请求 (半开)，成功则关闭，失败则重新打开。
+    打开 / 半开期间只有探测请求的结果会改变状态，熔断前已发出的请求迟到的结果被忽略。
+    同时维护重试预算：每个请求按比例存入额度，每次重试消耗 1，避免 API 降级时重试风暴。
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=None, cooldown_seconds=None, budget_ratio=None, budget_max=None):
+        self.failure_threshold = failure_threshold or config.TENDATA_BREAKER_FAILURES
+        self.cooldown_seconds = config.TENDATA_BREAKER_COOLDOWN_SECONDS if cooldown_seconds is None else cooldown_seconds
+        self.budget_ratio = config.TENDATA_RETRY_BUDGET_RATIO if budget_ratio is None else budget_ratio
+        self.budget_max = config.TENDATA_RETRY_BUDGET_MAX if budget_max is None else budget_max
+        self._cond = threading.Condition()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._budget = float(self.budget_max)
+
+    def before_request(self, max_wait=None):
+        """
+        熔断打开时阻塞到冷却结束 (半开状态只放行一个探测请求)。
+        返回 probe：本次是否为半开探测请求，需原样传给 record_success / record_failure。
+        """
+        deadline = time.time() + (self.cooldown_seconds * 2 if max_wait is None else max_wait)
+        with self._cond:
+            while True:
+                if self.state == self.OPEN and time.time() - self._opened_at >= self.cooldown_seconds:
+                    self.state = self.HALF_OPEN
+                if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._probing):
+                    probe = self.state == self.HALF_OPEN
+                    if probe: self._probing = True
+                    self._budget = min(self.budget_max, self._budget + self.budget_ratio)
+                    return probe
+                remaining = deadline - time.time()
+                if remaining <= 0: raise CircuitOpenError("Tendata API circuit open (API 暂时不可用，已熔断)")
+                self._cond.wait(timeout=min(remaining, 1.0))
+
+    def record_success(self, probe=False):
+        with self._cond:
+            if probe:
+                self._probing = False
+                self.state = self.CLOSED
+            if self.state == self.CLOSED:
+                self._failures = 0
+            self._cond.notify_all()
+
+    def record_failure(self, probe=False):
+        with self._cond:
+            if probe:
+                self._probing = False
+                self._open_locked()
+            elif self.state == self.CLOSED:
+                self._failures += 1
+                if self._failures >= self.failure_threshold: self._open_locked()
+            self._cond.notify_all()
+
+    def release(self, probe=False):
+        """请求没有结果 (被中断) 时交还半开探测名额，由下一个请求重新探测。"""
+        if not probe: return
+        with self._cond:
+            self._probing = False
+            self._cond.notify_all()
+
+    def _open_locked(self):
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        self._failures = 0
+
+    def try_spend_retry(self):
+        """从重试预算中扣除一次重试；预算不足时返回 False (不再重试)。"""
+        with self._cond:
+            if self._budget < 1: return False
+            self._budget -= 1
+            return True
+
+@st.cache_resource
+def get_circuit_breaker():
+    """进程级共享的熔断器 (所有会话、所有下载线程共用)。"""
+    return CircuitBreaker()
+
+class TokenBucket:
+    """
+    进程级令牌桶限流：按 rate (请求/秒) 匀速补充令牌，最多积攒 burst 个。
+    acquire() 在令牌不足时阻塞到下一个令牌可用，所有会话、页面和下载线程共用同一个桶。
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = float(rate or config.TENDATA_RATE_PER_SECOND)
+        self.burst = float(burst or config.TENDATA_RATE_BURST)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+@st.cache_resource
+def get_rate_limiter():
+    """进程级共享的 Tendata 限流器。"""
+    return TokenBucket()
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def backoff_seconds(attempt, retry_after=None):
+    """指数退避 + 全抖动 (full jitter)；服务端给出 Retry-After 时以其为下限。"""
+    delay = random.uniform(0, min(config.TENDATA_RETRY_MAX_SECONDS, config.TENDATA_RETRY_BASE_SECONDS * (2 ** attempt)))
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+def tendata_request(method, url, params=None, json_body=None, headers=None):
+    """
+    通过共享 Session 发送请求，统一设置连接/读取超时，可选 gzip 压缩请求体。
+    每次尝试 (包括重试) 都经过进程级令牌桶限流；
+    超时、网络错误、429 和 5xx 按指数退避 + 抖动重试 (受重试预算限制)，并经过进程级熔断器。
+    重试耗尽后抛出最后一个异常 / 返回最后一个响应。
+    """
+    headers = dict(headers or {})
+    kwargs = {}
+    if json_body is not None:
+        if config.TENDATA_GZIP_REQUEST:
+            kwargs['data'] = gzip.compress(json.dumps(json_body).encode('utf-8'))
+            headers['Content-Type'] = "application/json"
+            headers['Content-Encoding'] = "gzip"
         else:
-            st.error(f"🔐 自动登录失败: {res_json}")
-            if 'access_token' in st.session_state: del st.session_state['access_token']
+            kwargs['json'] = json_body
+    timeout = (config.TENDATA_CONNECT_TIMEOUT, config.TENDATA_READ_TIMEOUT)
+    breaker = get_circuit_breaker()
+    attempt = 0
+    while True:
+        probe = breaker.before_request()
+        retry_after = None
+        try:
+            get_rate_limiter().acquire()
+            response = get_tendata_session().request(method, url, params=params, headers=headers, timeout=timeout, **kwargs)
+        except (requests.Timeout, requests.ConnectionError):
+            breaker.record_failure(probe)
+            if attempt >= config.TENDATA_RETRY_MAX_ATTEMPTS or not breaker.try_spend_retry(): raise
+        except Exception:
+            # 其他异常 (ChunkedEncodingError、InvalidURL 等) 不重试，但必须记录结果，否则半开探测会一直占用
+            breaker.record_failure(probe)
+            raise
+        except BaseException:
+            # 线程被中断 (KeyboardInterrupt 等)：不计入失败，只交还探测名额
+            breaker.release(probe)
+            raise
+        else:
+            if response.status_code not in RETRYABLE_STATUS:
+                breaker.record_success(probe)
+                return response
+            breaker.record_failure(probe)
+            if attempt >= config.TENDATA_RETRY_MAX_ATTEMPTS or not breaker.try_spend_retry(): return response
+            retry_after = response.headers.get('Retry-After')
+        time.sleep(backoff_seconds(attempt, retry_after))
+        attempt += 1
+
+# --- 2. 自动 Token 管理 (进程级共享，线程安全) ---
+class TokenManager:
+    """
+    整个进程只持有一个 Access Token，所有浏览器会话、页面和下载线程共用。
+    - 剩余有效期小于 refresh_margin 时提前刷新：由一个调用方刷新，其余调用方继续使用旧 Token
+    - 单飞 (single-flight)：同一时刻只有一个刷新请求，并发的调用方等待它的结果
+    - 不依赖 st.session_state，可在工作线程中直接调用
+    """
+
+    def __init__(self, api_key, refresh_margin=None):
+        self.api_key = api_key
+        self.refresh_margin = config.TOKEN_REFRESH_MARGIN_SECONDS if refresh_margin is None else refresh_margin
+        self._lock = threading.Lock()          # 保护 _token / _expires_at
+        self._refresh_lock = threading.Lock()  # 单飞刷新
+        self._token = None
+        self._expires_at = 0.0
+        self.last_error = None
+
+    def current_token(self):
+        """当前持有的 Token (不检查有效期，不触发刷新)。"""
+        with self._lock:
+            return self._token
+
+    def expires_at(self):
+        """当前 Token 的过期时间戳 (没有 Token 时为 0)。"""
+        with self._lock:
+            return self._expires_at if self._token else 0.0
+
+    def get_token(self, force_refresh=False):
+        """返回可用的 Token；失败时返回 None (原因见 last_error)。"""
+        with self._lock:
+            token, expires_at = self._token, self._expires_at
+        now = time.time()
+        if token and not force_refresh and now < expires_at:
+            if now < expires_at - self.refresh_margin: return token
+            # 即将过期：抢到刷新权的调用方提前刷新，其余调用方不等待
+            if not self._refresh_lock.acquire(blocking=False): return token
+            try:
+                return self._request_token() or token
+            finally:
+                self._refresh_lock.release()
+        return self.refresh(stale_token=token)
+
+    def refresh(self, stale_token=None):
+        """
+        强制刷新 (如收到 40302)。传入调用方手里失效的 Token：
+        如果等待期间其他线程已经换了新 Token，直接返回新的，不再重复请求。
+        """
+        with self._refresh_lock:
+            with self._lock:
+                token, expires_at = self._token, self._expires_at
+            if token and token != stale_token and time.time() < expires_at:
+                return token
+            return self._request_token()
+
+    def _request_token(self):
+        auth_url = tendata_url("/v2/access-token")
+        try:
+            res_json = tendata_request("GET", auth_url, params={"apiKey": self.api_key}).json()
+        except Exception as e:
+            self.last_error = f"🔐 认证网络错误: {e}"
             return None
-    except Exception as e:
-        st.error(f"🔐 认证网络错误: {e}")
-        return None
+        if str(res_json.get('code')) != '200':
+            self.last_error = f"🔐 自动登录失败: {res_json}"
+            with self._lock:
+                self._token, self._expires_at = None, 0.0
+            return None
+        data = res_json.get('data', {})
+        # API 返回的是 expiresIn: 7200 (秒)，可能是数字字符串
+        expires_in_seconds = data.get('expiresIn', 7200)
+        if isinstance(expires_in_seconds, str) and expires_in_seconds.isdigit():
+            expires_in_seconds = int(expires_in_seconds)
+        with self._lock:
+            self._token = data.get('accessToken')
+            self._expires_at = time.time() + expires_in_seconds
+        self.last_error = None
+        return self._token
+
+@st.cache_resource
+def get_token_manager():
+    """进程级共享的 Token 管理器 (跨会话、跨页面以及 importlib.reload 只创建一次)。"""
+    return TokenManager(TENDATA_API_KEY)
+
+def get_auto_token(force_refresh=False):
+    """
+    获取访问 Token (Access Token)，供页面调用；失败时在页面上提示错误。
+    :param force_refresh: 如果为 True，将忽略缓存，强制向 API 请求新 Token
+    """
+    manager = get_token_manager()
+    token = manager.refresh(stale_token=manager.current_token()) if force_refresh else manager.get_token()
+    if not token and manager.last_error: st.error(manager.last_error)
+    return token
+
+def get_token_expiry():
+    """当前共享 Token 的过期时间戳 (没有 Token 时为 0)。"""
+    return get_token_manager().expires_at()
 
 # --- 3. 新增：获取账户详细信息 ---
 def get_remote_account_info(token):
@@ -88,7 +404,7 @@ def get_remote_account_info(token):
     
     try:
         # 发送 GET 请求
-        res = requests.get(ACCOUNT_INFO_URL, headers=headers)
+        res = tendata_request("GET", tendata_url("/v2/account"), headers=headers)
         res_json = res.json()
         
         # print(f"💰 [DEBUG] Account Info Response: {res_json}") # 调试用
@@ -104,6 +420,20 @@ def get_remote_account_info(token):
         st.error(f"❌ 账户查询网络错误: {e}")
         return None
 
+def get_account_balance(token=None):
+    """
+    读取账户剩余点数 (float)，失败时返回 None。
+    不调用 st.*，可在后台任务线程中使用 (用于任务前后的余额快照)。
+    """
+    token = token or get_token_manager().get_token()
+    if not token: return None
+    try:
+        res_json = tendata_request("GET", tendata_url("/v2/account"), headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"}).json()
+        if str(res_json.get('code')) != '200': return None
+        return float(str((res_json.get('data') or {}).get('balance')).replace(',', ''))
+    except Exception:
+        return None
+
 # --- 4. 业务逻辑函数 ---
 
 def identify_species(description_text):
@@ -115,14 +445,93 @@ def identify_species(description_text):
                 return species
     return "Other"
 
+def clean_port_name(val):
+    """'NHAVA SHEVA (INNSA1)' -> 'INNSA1'：取括号内的代码/名称，否则原样去空格。"""
+    s = str(val).strip()
+    if '(' in s: return s.split('(')[-1].replace(')', '').strip()
+    return s
+
+def canonical_port_name(val):
+    """到港港口的标准名称：括号清洗 -> 名称修正 -> 港口代码转名称。"""
+    s = clean_port_name(val)
+    s = config.PORT_NAME_FIX_MAP.get(s, s)
+    return config.PORT_CODE_TO_NAME.get(s, s)
+
+def map_hs_to_category(hs_code):
+    hs_str = str(hs_code)
+    for category, codes in config.HS_CODES_MAP.items():
+        for c in codes:
+            if hs_str.startswith(c):
+                return category
+    return "Other Products"
+
+def country_name_en(code):
+    if pd.isna(code) or code == "" or code is None: return "Unknown"
+    full_name_str = str(config.COUNTRY_NAME_MAP.get(code, code))
+    if '(' in full_name_str: return full_name_str.split(' (')[0]
+    return full_name_str
+
+def enrich_row(row):
+    """入库前计算派生列 (树种、产品分类、标准港口、国家名)，原地写入 row 并返回。"""
+    row["species"] = identify_species(row.get("product_desc_text"))
+    row["product_category"] = map_hs_to_category(row.get("hs_code"))
+    row["port_of_departure_clean"] = clean_port_name(row.get("port_of_departure") or "Unknown")
+    row["port_of_arrival_clean"] = canonical_port_name(row.get("port_of_arrival") or "Unknown")
+    row["origin_name"] = country_name_en(row.get("origin_country_code"))
+    row["dest_name"] = country_name_en(row.get("dest_country_code"))
+    return row
+
+def _fill_derived(df, target, stored, source, func):
+    """target 列优先取库中的派生列 stored；旧记录 (为空) 才按 source 计算，同一取值只算一次。"""
+    values = df[stored] if stored in df.columns else pd.Series(None, index=df.index, dtype=object)
+    missing = values.isna()
+    if missing.any():
+        cache = {}
+        def lookup(v):
+            if v not in cache: cache[v] = func(v)
+            return cache[v]
+        values = values.astype(object).copy()
+        values[missing] = df.loc[missing, source].map(lookup) if source in df.columns else func(None)
+    df[target] = values
+
+def enrich_frame(df):
+    """
+    把从 trade_records 读出的数据整理为页面使用的列：Species、Product_Category、origin_name、dest_name，
+    以及清洗后的 port_of_arrival / port_of_departure。入库时已计算的派生列直接使用，缺失的才在本地补算。
+    """
+    _fill_derived(df, 'Species', 'species', 'product_desc_text', identify_species)
+    _fill_derived(df, 'Product_Category', 'product_category', 'hs_code', map_hs_to_category)
+    _fill_derived(df, 'origin_name', 'origin_name', 'origin_country_code', country_name_en)
+    _fill_derived(df, 'dest_name', 'dest_name', 'dest_country_code', country_name_en)
+    if 'port_of_departure' not in df.columns: df['port_of_departure'] = 'Unknown'
+    df['port_of_departure'] = df['port_of_departure'].fillna('Unknown')
+    df['port_of_arrival'] = df['port_of_arrival'].fillna('Unknown')
+    _fill_derived(df, 'port_of_departure', 'port_of_departure_clean', 'port_of_departure', clean_port_name)
+    _fill_derived(df, 'port_of_arrival', 'port_of_arrival_clean', 'port_of_arrival', canonical_port_name)
+    df.drop(columns=[c for c in ('species', 'product_category', 'port_of_departure_clean', 'port_of_arrival_clean') if c in df.columns], inplace=True)
+    df.attrs['enriched'] = True
+    return df
+
+def species_keywords(species_list, synonyms=False):
+    """
+    选中树种对应的 API 关键词 (多树种扇出用)：默认每个树种取第一个关键词，
+    synonyms=True 时取 config.SPECIES_KEYWORDS 中的全部同义词；去重并保持顺序。
+    """
+    keywords = []
+    for species in species_list or []:
+        candidates = config.SPECIES_KEYWORDS.get(species, [])
+        for kw in (candidates if synonyms else candidates[:1]):
+            if kw not in keywords: keywords.append(kw)
+    return keywords
+
 def fetch_tendata_api(hs_code, start_date, end_date, token, trade_type="imports", origin_codes=None, dest_codes=None, just_checking=False, page_no=1, keyword=None, retry_count=0):
     """获取数据，包含自动重试机制 (40302 Token失效自动修复)"""
-    url = "https://open-api.tendata.cn/v2/trade"
+    url = tendata_url("/v2/trade")
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     
     payload = {
         "pageNo": page_no, 
-        "pageSize": 1 if just_checking else 100, 
+        "pageSize": 1 if just_checking else config.DOWNLOAD_PAGE_SIZE, 
         "catalog": trade_type,
         "startDate": str(start_date), 
         "endDate": str(end_date), 
@@ -144,19 +553,24 @@ def fetch_tendata_api(hs_code, start_date, end_date, token, trade_type="imports"
                 pass
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = tendata_request("POST", url, json_body=payload, headers=headers)
+        if response.status_code in RETRYABLE_STATUS:
+            return {"code": response.status_code, "msg": f"HTTP {response.status_code} (retries exhausted)"}
         res_json = response.json()
         
         # 🔥 检测 40302 Token 无效错误并自动重试
         if str(res_json.get('code')) == '40302':
-            if retry_count < 1: # 只重试一次
-                new_token = get_auto_token(force_refresh=True)
+            # 最多重试两次：调用方持有的旧 Token 失效时，refresh 可能先返回管理器里的当前 Token；
+            # 如果它也已被服务端作废，重试时再以刚用过的 Token 为 stale_token 强制刷新
+            if retry_count < 2:
+                # 工作线程中也可调用：不依赖 session_state，并发的 40302 只触发一次刷新
+                new_token = get_token_manager().refresh(stale_token=token)
                 if new_token:
                     return fetch_tendata_api(
                         hs_code, start_date, end_date, 
                         new_token, 
                         trade_type, origin_codes, dest_codes, just_checking, page_no, keyword, 
-                        retry_count=1
+                        retry_count=retry_count + 1
                     )
                 else:
                     return {"code": 40302, "msg": "Token refresh failed"}
@@ -168,13 +582,77 @@ def fetch_tendata_api(hs_code, start_date, end_date, token, trade_type="imports"
     except Exception as e:
         return {"code": 500, "msg": str(e)}
 
-def save_to_supabase(api_json_data):
-    if not supabase: return 0, 0
-    data_node = api_json_data.get('data', {})
+def get_api_total(api_json_data):
+    """从 API 响应中读取记录总数 (兼容 total / totalElements 两种字段)。"""
+    data_node = api_json_data.get('data', {}) if api_json_data else {}
+    if not isinstance(data_node, dict): return 0
+    count = data_node.get('total', 0)
+    if not count: count = data_node.get('totalElements', 0)
+    try:
+        return int(count or 0)
+    except (TypeError, ValueError):
+        return 0
+
+class TTLCache:
+    """线程安全的小型 TTL 缓存 (只缓存成功结果，过期后自动失效)。"""
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None: return None
+            if time.time() - item[0] > self.ttl_seconds:
+                del self._items[key]
+                return None
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.time(), value)
+            if len(self._items) > 10000:
+                now = time.time()
+                self._items = {k: v for k, v in self._items.items() if now - v[0] <= self.ttl_seconds}
+
+@st.cache_resource
+def get_api_count_cache():
+    """进程级共享的 API 计数缓存 (不同会话检查同一组条件时直接复用)。"""
+    return TTLCache(config.API_COUNT_CACHE_TTL)
+
+def fetch_api_count(hs_code, start_date, end_date, token, trade_type="imports", origin_codes=None, dest_codes=None, keyword=None, use_cache=True):
+    """
+    查询某组条件在 API 上的记录总数 (pageSize=1 预检)，成功结果按完整查询条件缓存 API_COUNT_CACHE_TTL 秒。
+    返回 {"ok": bool, "total": int, "code": ..., "msg": str, "cached": bool}
+    token 只在 TokenManager 取不到 Token 时使用：规划 / 预检线程池可能在 Token 轮换之后才执行，每次请求都取当前 Token。
+    """
+    key = (str(hs_code), str(start_date), str(end_date), trade_type,
+           tuple(sorted(origin_codes or [])), tuple(sorted(dest_codes or [])), keyword or "")
+    cache = get_api_count_cache()
+    if use_cache:
+        total = cache.get(key)
+        if total is not None: return {"ok": True, "total": total, "code": 200, "msg": "", "cached": True}
+    token = get_token_manager().get_token() or token
+    res = fetch_tendata_api(hs_code, start_date, end_date, token, trade_type, origin_codes, dest_codes, just_checking=True, keyword=keyword)
+    if res and str(res.get('code')) == '200':
+        total = get_api_total(res)
+        cache.put(key, total)
+        return {"ok": True, "total": total, "code": 200, "msg": "", "cached": False}
+    return {"ok": False, "total": 0, "code": res.get('code', 'N/A') if res else 'N/A',
+            "msg": res.get('msg', 'Unknown Error') if res else 'No Response', "cached": False}
+
+def build_db_rows(api_json_data, trade_direction=None):
+    """
+    把 API 返回的一页数据映射为 trade_records 表的行 (不含写库)。
+    trade_direction: 请求时的 catalog (imports / exports)；数据库未执行 sql/001_trade_direction.sql 时不写入。
+    """
+    features = schema_features()
+    enrich = enrichment_enabled()
+    data_node = api_json_data.get('data', {}) if api_json_data else {}
     records = data_node.get('content', []) if isinstance(data_node, dict) else []
     
-    if not records: return 0, 0
-    
     db_rows = []
     for item in records:
         hs_code_val = item.get('hsCode')[0] if item.get('hsCode') else None
@@ -195,75 +673,115 @@ def save_to_supabase(api_json_data):
             "quantity": item.get('quantity'),
             "quantity_unit": item.get('quantityUnit'),
             "total_value_usd": item.get('sumOfUsd'),
-            "raw_data": item
         }
+        if trade_direction and features["trade_direction"]:
+            row["trade_direction"] = trade_direction
+        if enrich:
+            enrich_row(row)
+        if config.STORE_RAW_DATA:
+            row["raw_data"] = item
         db_rows.append(row)
+    return db_rows
+
+def upsert_trade_rows(db_rows, returning_minimal=False):
+    """按 unique_record_id 批量 upsert；失败时抛出异常，由调用方决定重试或报错。"""
+    get_trade_store().upsert(db_rows, returning_minimal=returning_minimal)
+
+def save_to_supabase(api_json_data):
+    """把一页 API 数据写入当前存储后端 (名称沿用旧接口)。"""
+    db_rows = build_db_rows(api_json_data)
+    if not db_rows: return 0, 0
     
     try:
-        supabase.table('trade_records').upsert(db_rows, on_conflict='unique_record_id').execute()
-        return len(db_rows), len(records)
+        upsert_trade_rows(db_rows)
+        return len(db_rows), len(db_rows)
     except Exception as e:
         st.error(f"Error saving DB: {e}")
-        return 0, len(records)
+        return 0, len(db_rows)
+
+def count_local_records(hs_code, start_date, end_date, trade_direction=None, origin_codes=None, dest_codes=None, keyword=None):
+    """
+    统计本地 trade_records 中某个 (HS 前缀, 日期范围, 方向, 国家, 关键词) 切片的记录数 (只取 count，不拉数据)。
+    trade_direction 为空的旧数据不计入任何方向。不带关键词时直接读覆盖日历。
+    数据库没有 trade_direction 列时无法按方向统计，返回 0 (视为未下载)。
+    """
+    if trade_direction and not schema_features()["trade_direction"]: return 0
+    if coverage_calendar_enabled() and not keyword:
+        return sum(int(r['count']) for r in get_trade_store().calendar_counts(
+            start_date=start_date, end_date=end_date, hs_prefixes=[hs_code], trade_direction=trade_direction,
+            origin_codes=origin_codes, dest_codes=dest_codes
+        ))
+    return get_trade_store().count(
+        start_date=start_date, end_date=end_date, hs_prefixes=[hs_code], trade_direction=trade_direction,
+        origin_codes=origin_codes, dest_codes=dest_codes, keyword=keyword
+    )
+
+ENRICH_SOURCE_COLUMNS = "unique_record_id,transaction_date,hs_code,product_desc_text,origin_country_code,dest_country_code,port_of_departure,port_of_arrival,importer_name,exporter_name,quantity,quantity_unit,total_value_usd"
+
+def backfill_enrichment(batch_size=None, on_progress=None, cancel_event=None):
+    """
+    为派生列为空的旧记录补算并写回 (keyset 分页逐批处理，可中断、可重复执行)。
+    写回时带上原有业务列，避免 upsert 的插入分支触发非空约束；raw_data 不动。
+    on_progress(done, total) 在调用线程中回调；返回本次回填的行数。
+    """
+    store = get_trade_store()
+    total = store.count(unenriched=True)
+    done = 0
+    for rows in store.iter_pages(ENRICH_SOURCE_COLUMNS, page_size=batch_size or config.ENRICH_BACKFILL_BATCH, unenriched=True):
+        if cancel_event is not None and cancel_event.is_set(): break
+        store.upsert([enrich_row(row) for row in rows], returning_minimal=True)
+        done += len(rows)
+        if on_progress: on_progress(done, total)
+    return done
 
 # --- 5. 库存检查函数 ---
 def check_data_coverage(target_hs_codes, check_start_date, check_end_date, origin_codes=None, dest_codes=None, target_species_list=None):
-    if not supabase: return pd.DataFrame()
+    """本地库存的每日记录数 (DataFrame: date, count)，用于 Local Stock Check 热力图。"""
     try:
-        # --- 1. 智能列选择 ---
-        select_cols = "transaction_date, hs_code"
-        
-        # 判断是否正在筛选特定国家
-        is_filtering_country = (origin_codes is not None and len(origin_codes) > 0)
-        
-        # 判断是否需要文本筛选
-        needs_text_filter = target_species_list and len(target_species_list) > 0
-        
-        # [优化策略]：如果正在筛选特定国家（如印度），为了速度和稳定性，牺牲文本字段扫描
-        if needs_text_filter and is_filtering_country:
-             needs_text_filter = False 
-        
-        if needs_text_filter:
-            select_cols += ", product_desc_text"
-
-        # --- 2. 构建查询 ---
-        query = supabase.table('trade_records')\
-            .select(select_cols)\
-            .gte('transaction_date', check_start_date)\
-            .lte('transaction_date', check_end_date)\
-            .order("transaction_date", desc=True)
-            
-        # --- 3. 智能限流 ---
-        if is_filtering_country:
-            query = query.limit(20000)
-        else:
-            query = query.limit(100000)
-            
-        if origin_codes: query = query.in_('origin_country_code', origin_codes)
-        if dest_codes: query = query.in_('dest_country_code', dest_codes)
-        
-        # 执行查询
-        response = query.execute()
-        rows = response.data
-        if not rows: return pd.DataFrame()
+        # --- 1. 筛选条件 (HS 前缀、国家、树种均在数据库端过滤；未回填树种的旧记录见 2c) ---
+        filters = dict(
+            start_date=check_start_date, end_date=check_end_date, origin_codes=origin_codes, dest_codes=dest_codes,
+            hs_prefixes=[str(t) for t in target_hs_codes]
+        )
+        species_filter = list(target_species_list) if target_species_list else None
+        use_calendar = coverage_calendar_enabled() and not species_filter
         
-        df = pd.DataFrame(rows)
-        
-        # 4. Python 端过滤 HS Code
-        df['hs_str'] = df['hs_code'].astype(str)
-        df['match_hs'] = df['hs_str'].apply(lambda x: any(x.startswith(str(t)) for t in target_hs_codes))
-        df = df[df['match_hs']]
-        
-        if df.empty: return pd.DataFrame()
-        
-        # 5. 过滤树种 (如果开启)
-        if needs_text_filter and 'product_desc_text' in df.columns:
-            df['Species'] = df['product_desc_text'].apply(identify_species)
-            df = df[df['Species'].isin(target_species_list)]
+        if (species_filter and not enrichment_enabled()) or not (use_calendar or schema_features()["daily_counts"]):
+            # --- 2a. 未开启入库派生列或缺少聚合函数：拉取行在本地计数 / 识别树种 (有样本上限，繁忙时段可能被截断) ---
+            is_filtering_country = (origin_codes is not None and len(origin_codes) > 0)
+            rows = get_trade_store().select(
+                "transaction_date, product_desc_text", order_by="transaction_date", desc=True,
+                limit=20000 if is_filtering_country else 100000, **filters
+            )
+            if not rows: return pd.DataFrame()
+            df = pd.DataFrame(rows)
+            if species_filter:
+                df = df[df['product_desc_text'].apply(identify_species).isin(species_filter)]
             if df.empty: return pd.DataFrame()
+            daily_counts = df['transaction_date'].value_counts().reset_index()
+        elif use_calendar:
+            # --- 2b. 读取写入时维护的覆盖日历 (不扫描 trade_records) ---
+            rows = get_trade_store().calendar_counts(**filters)
+            if not rows: return pd.DataFrame()
+            daily_counts = pd.DataFrame(rows).groupby('transaction_date')['count'].sum().reset_index()
+        else:
+            # --- 2c. 数据库端按 (日期, HS) 聚合，精确计数，只传输聚合行 ---
+            store = get_trade_store()
+            rows = store.daily_counts(species=species_filter, **filters)
+            if species_filter:
+                # 尚未回填派生列的旧记录 (species 为空) 只拉取它们的描述文本，本地识别后并入计数
+                legacy = pd.DataFrame([
+                    row for page in store.iter_pages("transaction_date, unique_record_id, product_desc_text", unenriched=True, **filters)
+                    for row in page
+                ])
+                if not legacy.empty:
+                    st.info(f"ℹ️ {len(legacy)} records have no stored species yet and were matched locally. Run Backfill in Data Management to speed this up (部分旧记录尚未回填树种).")
+                    legacy = legacy[legacy['product_desc_text'].apply(identify_species).isin(species_filter)]
+                    rows = rows + [{"transaction_date": d, "count": n} for d, n in legacy['transaction_date'].value_counts().items()]
+            if not rows: return pd.DataFrame()
+            daily_counts = pd.DataFrame(rows).groupby('transaction_date')['count'].sum().reset_index()
 
-        # 6. 聚合统计
-        daily_counts = df['transaction_date'].value_counts().reset_index()
+        # --- 3. 输出格式 ---
         daily_counts.columns = ['date', 'count']
         daily_counts['date'] = pd.to_datetime(daily_counts['date'])
         return daily_counts
@@ -272,7 +790,7 @@ def check_data_coverage(target_hs_codes, check_start_date, check_end_date, origi
         # 捕获超时错误并友好提示
         err_str = str(e)
         if '57014' in err_str or 'timeout' in err_str.lower():
-            st.error("⚠️ 查询超时：该国家数据量过大。系统已自动限制查询样本，请尝试缩短日期范围或联系管理员添加索引。")
+            st.error("⚠️ 查询超时：请尝试缩短日期范围，或确认 sql/ 目录下的索引与 trade_daily_counts 函数已在数据库中创建。")
         else:
             st.error(f"⚠️ Check Logic Error: {err_str}")
         return pd.DataFrame()
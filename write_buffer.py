@@ -0,0 +1,170 @@
+# write_buffer.py
+# trade_records 写缓冲：跨页、跨 HS 收集行，按行数 / 字节数 / 时间阈值合并成大批次 upsert，
+# 由后台 flush 线程写库 (失败指数退避重试)，并精确报告未能入库的 unique_record_id。
+
+import collections
+import itertools
+import json
+import queue
+import threading
+import time
+import config
+import utils
+
+
+class WriteBuffer:
+    """
+    线程安全的写缓冲。
+    - add(rows, ticket): 加入一页的行；ticket 为可哈希的标识 (如 (hs, direction, page))，
+      当该页所有行都写库成功 / 最终失败后，回调 on_ticket_done(ticket, saved, failed_ids)
+    - 同一批次内按 unique_record_id 去重 (Postgres 不允许一条 upsert 语句两次更新同一行)
+    - 排队批次超过 max_pending 时 add() 阻塞，形成对上游的背压
+    """
+
+    def __init__(self, on_ticket_done=None, max_rows=None, max_bytes=None, max_seconds=None,
+                 max_pending=None, retries=None, backoff_seconds=None, returning_minimal=None):
+        self.on_ticket_done = on_ticket_done or (lambda ticket, saved, failed_ids: None)
+        self.max_rows = max_rows or config.WRITE_BUFFER_MAX_ROWS
+        self.max_bytes = max_bytes or config.WRITE_BUFFER_MAX_BYTES
+        self.max_seconds = max_seconds or config.WRITE_BUFFER_MAX_SECONDS
+        self.retries = config.WRITE_BUFFER_RETRIES if retries is None else retries
+        self.backoff_seconds = config.WRITE_BUFFER_BACKOFF_SECONDS if backoff_seconds is None else backoff_seconds
+        self.returning_minimal = config.WRITE_BUFFER_RETURNING_MINIMAL if returning_minimal is None else returning_minimal
+
+        self._lock = threading.Lock()
+        self._rows = collections.OrderedDict()      # unique_record_id -> row
+        self._row_tickets = {}                      # unique_record_id -> [ticket, ...]
+        self._bytes = 0
+        self._row_bytes = {}
+        self._oldest_at = None
+        self._ticket_rows = {}                      # ticket -> 待写行数
+        self._ticket_total = {}                     # ticket -> 总行数
+        self._ticket_failed = {}                    # ticket -> [失败 id]
+        self._noid = itertools.count()
+
+        self.stats = {"written": 0, "flushes": 0, "retries": 0, "busy_seconds": 0.0, "failed_ids": [], "errors": []}
+        self._batches = queue.Queue(maxsize=max_pending or config.WRITE_BUFFER_MAX_PENDING)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="write-buffer", daemon=True)
+        self._thread.start()
+
+    # --- 对外接口 ---
+    def add(self, rows, ticket=None):
+        if not rows:
+            if ticket is not None: self.on_ticket_done(ticket, 0, [])
+            return
+        with self._lock:
+            for row in rows:
+                rid = row.get('unique_record_id')
+                key = rid if rid is not None else ("__noid__", next(self._noid))
+                size = len(json.dumps(row, default=str))
+                if key in self._rows:
+                    self._bytes -= self._row_bytes[key]
+                else:
+                    self._row_tickets[key] = []
+                self._rows[key] = row
+                self._row_bytes[key] = size
+                self._bytes += size
+                if ticket is not None and ticket not in self._row_tickets[key]:
+                    self._row_tickets[key].append(ticket)
+                    self._ticket_rows[ticket] = self._ticket_rows.get(ticket, 0) + 1
+                    self._ticket_total[ticket] = self._ticket_total.get(ticket, 0) + 1
+                    self._ticket_failed.setdefault(ticket, [])
+            if self._oldest_at is None: self._oldest_at = time.time()
+            batch = self._take_locked() if self._is_full_locked() else None
+        if batch: self._batches.put(batch)
+
+    def depth(self):
+        """(排队等待写库的批次数, 缓冲中尚未成批的行数)，用于监控背压。"""
+        with self._lock:
+            return self._batches.qsize(), len(self._rows)
+
+    def flush(self):
+        """立即把当前缓冲交给 flush 线程，并等待所有排队批次写完。"""
+        with self._lock:
+            batch = self._take_locked()
+        if batch: self._batches.put(batch)
+        self._batches.join()
+
+    def close(self):
+        """flush 剩余数据并停止后台线程，返回 stats。"""
+        self.flush()
+        self._closed.set()
+        self._thread.join()
+        return self.stats
+
+    # --- 内部实现 ---
+    def _is_full_locked(self):
+        return len(self._rows) >= self.max_rows or self._bytes >= self.max_bytes
+
+    def _is_due_locked(self):
+        return bool(self._rows) and self._oldest_at is not None and time.time() - self._oldest_at >= self.max_seconds
+
+    def _take_locked(self):
+        if not self._rows: return None
+        batch = (list(self._rows.items()), self._row_tickets)
+        self._rows = collections.OrderedDict()
+        self._row_tickets = {}
+        self._row_bytes = {}
+        self._bytes = 0
+        self._oldest_at = None
+        return batch
+
+    def _flush_loop(self):
+        while True:
+            try:
+                batch = self._batches.get(timeout=0.5)
+            except queue.Empty:
+                if self._closed.is_set(): return
+                with self._lock:
+                    batch = self._take_locked() if self._is_due_locked() else None
+                if batch:
+                    # 走队列，保证 flush() 的 join 也会等待这一批
+                    try:
+                        self._batches.put_nowait(batch)
+                    except queue.Full:
+                        self._write_batch(batch)
+                continue
+            try:
+                self._write_batch(batch)
+            finally:
+                self._batches.task_done()
+
+    def _write_batch(self, batch):
+        items, row_tickets = batch
+        rows = [row for _, row in items]
+        error = None
+        started = time.time()
+        for attempt in range(self.retries + 1):
+            try:
+                utils.upsert_trade_rows(rows, returning_minimal=self.returning_minimal)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    self.stats['retries'] += 1
+                    time.sleep(self.backoff_seconds * (2 ** attempt))
+
+        done_tickets = []
+        with self._lock:
+            self.stats['flushes'] += 1
+            self.stats['busy_seconds'] += time.time() - started
+            if error is None:
+                self.stats['written'] += len(rows)
+            else:
+                failed = [row.get('unique_record_id') for row in rows]
+                self.stats['failed_ids'].extend(failed)
+                self.stats['errors'].append(f"{len(rows)} rows not persisted: {error}")
+            for key, row in items:
+                for ticket in row_tickets.get(key, []):
+                    self._ticket_rows[ticket] -= 1
+                    if error is not None:
+                        self._ticket_failed[ticket].append(row.get('unique_record_id'))
+                    if self._ticket_rows[ticket] == 0:
+                        failed_ids = self._ticket_failed.pop(ticket)
+                        rows_total = self._ticket_total.pop(ticket)
+                        del self._ticket_rows[ticket]
+                        done_tickets.append((ticket, rows_total - len(failed_ids), failed_ids))
+        for ticket, saved, failed_ids in done_tickets:
+            self.on_ticket_done(ticket, saved, failed_ids)